@@ -7,6 +7,12 @@ Created on Tue Oct 23 20:48:27 2018
 
 """
 
+import collections
+import functools
+import math
+
+import numpy as np
+
 
 #=============================================================
 # Alignment Parameters
@@ -37,6 +43,15 @@ class ScoreParam:
                 self.match, self.mismatch, self.gap_start, self.gap
         )
 
+    def _key(self):
+        return (self.match, self.mismatch, self.gap, self.gap_start)
+
+    def __eq__(self, other):
+        return isinstance(other, ScoreParam) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
 def make_matrix(sizex, sizey):
     #   Taken from code generated by Carl Kingsford at CMU
     #   https://www.cs.cmu.edu/~ckingsf/bioinfo-lectures/align.py
@@ -77,36 +92,261 @@ def print_matrix(x, y, A):
 
 
 
-def local_align(x, y, score=ScoreParam(10, -5, -7), print_output = False):
+def encode(seq):
+    """Return seq as a uint8 NumPy array (one byte per base).  Packed
+    sequences (anything with to_array, e.g. sequences.PackedSequence)
+    are unpacked straight into the array."""
+    if isinstance(seq, np.ndarray):
+        return seq.astype(np.uint8, copy=False)
+    if hasattr(seq, "to_array"):
+        return seq.to_array()
+    if isinstance(seq, str):
+        seq = seq.encode("ascii")
+    return np.frombuffer(seq, dtype=np.uint8)
+
+
+def query_profile(x, y, score):
+    """Precompute the substitution scores of every distinct base of x
+    against the whole of y.  Returns a dict base -> row of len(y) scores,
+    so a DP row only needs one lookup instead of len(y) matchchar calls."""
+    xa = encode(x)
+    ya = encode(y)
+    profile = {}
+    for c in np.unique(xa):
+        profile[c] = np.where(ya == c, score.match, score.mismatch)
+    return xa, profile
+
+
+def _score_dtype(score):
+    """int64 for integer scoring parameters, float64 otherwise."""
+    dtype = np.result_type(score.match, score.mismatch, score.gap,
+                           score.gap_start)
+    return np.dtype(np.int64) if dtype.kind in "iub" else np.dtype(np.float64)
+
+
+def _last_argmax(row):
+    """Index of the last occurrence of the maximum of row."""
+    return len(row) - 1 - int(np.argmax(row[::-1]))
+
+
+def _local_align_python(x, y, score, keep_matrix=True):
     #   Taken from code generated by Carl Kingsford at CMU
     #   https://www.cs.cmu.edu/~ckingsf/bioinfo-lectures/align.py
 
     #   modified for python3 by jdkangas October 23, 2018
-    """Do a local alignment between x and y with the given scoring parameters.
-    We assume we are MAXIMIZING."""
+    """Reference pure-Python Smith-Waterman fill.  Without keep_matrix
+    only the previous and current rows are kept."""
+
+    if score.gap_start:
+        return _local_align_python_affine(x, y, score, keep_matrix)
 
-    # create a zero-filled matrix
-    A = make_matrix(len(x) + 1, len(y) + 1)
+    # create a zero-filled matrix (or just its first row)
+    A = make_matrix(len(x) + 1, len(y) + 1) if keep_matrix else None
+    prev = [0] * (len(y) + 1)
 
     best = 0
     optloc = (0,0)
 
     # fill in A in the right order
     for i in range(1, len(x)+1):
+        cur = A[i] if keep_matrix else [0] * (len(y) + 1)
         for j in range(1, len(y)+1):
 
             # the local alignment recurrance rule:
-            A[i][j] = max(
-               A[i][j-1] + score.gap,
-               A[i-1][j] + score.gap,
-               A[i-1][j-1] + score.matchchar(x[i-1], y[j-1]),
+            cur[j] = max(
+               cur[j-1] + score.gap,
+               prev[j] + score.gap,
+               prev[j-1] + score.matchchar(x[i-1], y[j-1]),
                0
             )
 
             # track the cell with the largest score
-            if A[i][j] >= best:
-                best = A[i][j]
+            if cur[j] >= best:
+                best = cur[j]
                 optloc = (i,j)
+        prev = cur
+
+    return best, optloc, A
+
+
+def _local_align_python_affine(x, y, score, keep_matrix=True):
+    """Reference pure-Python Gotoh fill.  A gap of length k costs
+    gap_start + k*gap.  H is the local alignment score, E ends in a gap
+    in x (horizontal move) and F ends in a gap in y (vertical move)."""
+    NEG = float("-inf")
+    open_gap = score.gap_start + score.gap
+
+    A = make_matrix(len(x) + 1, len(y) + 1) if keep_matrix else None
+    prev = [0] * (len(y) + 1)
+    prevF = [NEG] * (len(y) + 1)
+
+    best = 0
+    optloc = (0,0)
+
+    for i in range(1, len(x)+1):
+        cur = A[i] if keep_matrix else [0] * (len(y) + 1)
+        curF = [NEG] * (len(y) + 1)
+        E = NEG
+        for j in range(1, len(y)+1):
+            E = max(E + score.gap, cur[j-1] + open_gap)
+            curF[j] = max(prevF[j] + score.gap, prev[j] + open_gap)
+            cur[j] = max(
+               E,
+               curF[j],
+               prev[j-1] + score.matchchar(x[i-1], y[j-1]),
+               0
+            )
+
+            if cur[j] >= best:
+                best = cur[j]
+                optloc = (i,j)
+        prev, prevF = cur, curF
+
+    return best, optloc, A
+
+
+def _local_align_numpy(x, y, score, keep_matrix=True, profile=None):
+    """Row-vectorized Smith-Waterman fill.
+
+    The within-row dependency A[i][j-1] + gap is resolved with a running
+    maximum: A[i][j] = max over k <= j of C[k] + (j-k)*gap, where C holds
+    the diagonal/up/zero candidates for the row.  Without keep_matrix only
+    two rows of len(y)+1 scores are allocated.  A precomputed profile
+    (see query_profile) may be passed in place of scoring against y."""
+    if score.gap_start:
+        return _local_align_numpy_affine(x, y, score, keep_matrix, profile)
+
+    n, m = len(x), len(y)
+    dtype = _score_dtype(score)
+    if keep_matrix:
+        A = np.zeros((n + 1, m + 1), dtype=dtype)
+    else:
+        A = None
+        rows = np.zeros((2, m + 1), dtype=dtype)
+
+    best = 0
+    optloc = (0,0)
+    if n == 0 or m == 0:
+        return best, optloc, A
+
+    if profile is None:
+        xa, profile = query_profile(x, y, score)
+    else:
+        xa = encode(x)
+    jgap = np.arange(m + 1, dtype=dtype) * score.gap
+    C = np.zeros(m + 1, dtype=dtype)
+
+    for i in range(1, n + 1):
+        if keep_matrix:
+            prev, row = A[i - 1], A[i]
+        else:
+            prev, row = rows[(i - 1) & 1], rows[i & 1]
+        np.maximum(prev[:-1] + profile[xa[i - 1]], prev[1:] + score.gap,
+                   out=C[1:])
+        np.maximum(C[1:], 0, out=C[1:])
+        np.subtract(C, jgap, out=row)
+        np.maximum.accumulate(row, out=row)
+        row += jgap
+
+        # same tie-breaking as the reference: last cell with the top score
+        rowbest = row[1:].max()
+        if rowbest >= best:
+            best = rowbest.item()
+            optloc = (i, _last_argmax(row[1:]) + 1)
+
+    return best, optloc, A
+
+
+def _local_align_numpy_affine(x, y, score, keep_matrix=True, profile=None):
+    """Row-vectorized Gotoh fill (affine gaps), same contract as
+    _local_align_numpy.  Assumes non-positive gap_start and gap.
+
+    F (gap in y) only depends on the previous row.  With D[j] the best of
+    zero, the diagonal move and F[j], the horizontal gap state unrolls to
+    E[j] = gap_start + max over k < j of D[k] + (j-k)*gap, which is again a
+    running maximum.  With gap_start = 0 this reduces exactly to the
+    linear-gap recurrence."""
+    if score.gap_start > 0 or score.gap > 0:
+        assert profile is None
+        return _local_align_python_affine(x, y, score, keep_matrix)
+
+    n, m = len(x), len(y)
+    dtype = _score_dtype(score)
+    NEG = np.iinfo(dtype).min // 2 if dtype.kind == "i" else -np.inf
+    if keep_matrix:
+        A = np.zeros((n + 1, m + 1), dtype=dtype)
+    else:
+        A = None
+        rows = np.zeros((2, m + 1), dtype=dtype)
+
+    best = 0
+    optloc = (0,0)
+    if n == 0 or m == 0:
+        return best, optloc, A
+
+    if profile is None:
+        xa, profile = query_profile(x, y, score)
+    else:
+        xa = encode(x)
+    jgap = np.arange(m + 1, dtype=dtype) * score.gap
+    open_gap = score.gap_start + score.gap
+    F = np.full(m + 1, NEG, dtype=dtype)
+    D = np.zeros(m + 1, dtype=dtype)
+    E = np.empty(m + 1, dtype=dtype)
+
+    for i in range(1, n + 1):
+        if keep_matrix:
+            prev, row = A[i - 1], A[i]
+        else:
+            prev, row = rows[(i - 1) & 1], rows[i & 1]
+        F += score.gap
+        np.maximum(F, prev + open_gap, out=F)
+        np.add(prev[:-1], profile[xa[i - 1]], out=D[1:])
+        np.maximum(D[1:], F[1:], out=D[1:])
+        np.maximum(D[1:], 0, out=D[1:])
+        np.subtract(D, jgap, out=E)
+        np.maximum.accumulate(E, out=E)
+        np.add(E[:-1], jgap[1:], out=row[1:])
+        row[1:] += score.gap_start
+        np.maximum(row, D, out=row)
+
+        rowbest = row[1:].max()
+        if rowbest >= best:
+            best = rowbest.item()
+            optloc = (i, _last_argmax(row[1:]) + 1)
+
+    return best, optloc, A
+
+
+ENGINES = {
+    "python": _local_align_python,
+    "numpy": _local_align_numpy,
+}
+
+
+def local_align(x, y, score=ScoreParam(10, -5, -7), print_output = False,
+                engine="numpy", keep_matrix=False):
+    #   Taken from code generated by Carl Kingsford at CMU
+    #   https://www.cs.cmu.edu/~ckingsf/bioinfo-lectures/align.py
+
+    #   modified for python3 by jdkangas October 23, 2018
+    """Do a local alignment between x and y with the given scoring parameters.
+    We assume we are MAXIMIZING.
+
+    engine selects the implementation: "numpy" (default) or the original
+    pure-Python "python" loops.  Both give identical scores, locations
+    and matrices.
+
+    A non-zero score.gap_start switches to affine gap scoring (Gotoh),
+    where a gap of length k costs gap_start + k*gap.
+
+    The full score matrix is only built when keep_matrix or print_output
+    is set; otherwise just two rows are kept (O(len(y)) memory) and the
+    third element of the result is None."""
+
+    keep_matrix = keep_matrix or print_output
+    best, optloc, A = ENGINES[engine](x, y, score, keep_matrix)
+
     if print_output:
         print ("Scoring:", str(score))
         print ("A matrix =")
@@ -114,9 +354,1012 @@ def local_align(x, y, score=ScoreParam(10, -5, -7), print_output = False):
         print ("Optimal Score =", best)
         print ("Max location in matrix =", optloc)
     
-    # return the opt score, the best location, and the score matrix
+    # return the opt score, the best location, and the score matrix (if kept)
     return best, optloc, A
 
 
 
-#local_align("ACTG", "ACTGACTGACTG", score=ScoreParam(10, -5, -7))
\ No newline at end of file
+def _batch_dtype(score, max_query, width):
+    """int32 when every intermediate of a batched fill provably fits,
+    otherwise the usual scoring dtype."""
+    dtype = _score_dtype(score)
+    if dtype.kind == "i":
+        bound = (max_query * abs(score.match) + (width + 1) * abs(score.gap)
+                 + abs(score.gap_start) + abs(score.mismatch))
+        if bound < 2**30:
+            dtype = np.dtype(np.int32)
+    return dtype
+
+
+def _batch_fill(qa, qlen, substitution, width, score, dtype, valid=None):
+    """Shared kernel of the batched aligners.
+
+    qa is a (B, L) array of padded queries with lengths qlen,
+    substitution(i) returns the (B, width) substitution scores of query
+    column i-1 against each row's template, and valid optionally masks
+    the template columns that exist for each row (padding is never
+    reported as a best cell).  Runs the local_align recurrence (linear or
+    Gotoh) on all B problems at once and returns (best, optloc) with the
+    same tie-breaking as local_align."""
+    B, L = qa.shape
+    m = width
+    jgap = np.arange(m + 1, dtype=dtype) * dtype.type(score.gap)
+    affine = score.gap_start != 0
+    open_gap = score.gap_start + score.gap
+    NEG = np.iinfo(dtype).min // 2 if dtype.kind == "i" else -np.inf
+
+    prev = np.zeros((B, m + 1), dtype=dtype)
+    row = np.zeros((B, m + 1), dtype=dtype)
+    D = np.zeros((B, m + 1), dtype=dtype)
+    tmp = np.empty((B, m), dtype=dtype)
+    if affine:
+        F = np.full((B, m + 1), NEG, dtype=dtype)
+        E = np.empty((B, m + 1), dtype=dtype)
+    if valid is not None:
+        invalid = ~valid
+    best = np.zeros(B, dtype=dtype)
+    optloc = np.zeros((B, 2), dtype=np.int64)
+
+    for i in range(1, L + 1):
+        # same recurrences as the single-query engines, one row per problem
+        np.add(prev[:, :-1], substitution(i), out=D[:, 1:])
+        if affine:
+            F += score.gap
+            np.maximum(F, prev + open_gap, out=F)
+            np.maximum(D[:, 1:], F[:, 1:], out=D[:, 1:])
+        else:
+            np.add(prev[:, 1:], score.gap, out=tmp)
+            np.maximum(D[:, 1:], tmp, out=D[:, 1:])
+        np.maximum(D[:, 1:], 0, out=D[:, 1:])
+        if affine:
+            np.subtract(D, jgap, out=E)
+            np.maximum.accumulate(E, axis=1, out=E)
+            np.add(E[:, :-1], jgap[1:], out=row[:, 1:])
+            row[:, 1:] += score.gap_start
+            np.maximum(row, D, out=row)
+        else:
+            np.subtract(D, jgap, out=row)
+            np.maximum.accumulate(row, axis=1, out=row)
+            row += jgap
+        if valid is not None:
+            # padding sits to the right of each template, so it can only
+            # feed other padding cells
+            row[:, 1:][invalid] = NEG
+
+        rowbest = row[:, 1:].max(axis=1)
+        update = (rowbest >= best) & (i <= qlen)
+        if update.any():
+            tail = row[update, :0:-1] == rowbest[update, None]
+            best[update] = rowbest[update]
+            optloc[update, 0] = i
+            optloc[update, 1] = m - np.argmax(tail, axis=1)
+        prev, row = row, prev
+
+    # problems with an empty query never update and stay at (0, 0)
+    return best, optloc
+
+
+def _pad_queries(queries, lens):
+    """Pack byte strings into a zero-padded (B, max(lens)) uint8 array."""
+    qa = np.zeros((len(queries), max(int(lens.max()), 1)), dtype=np.uint8)
+    for r, q in enumerate(queries):
+        qa[r, :lens[r]] = encode(q)
+    return qa
+
+
+def local_align_many(queries, template, score=ScoreParam(10, -5, -7),
+                     batch_size=64):
+    """Align every query in queries against the same template.
+
+    The template is encoded once and the queries are padded into a 2-D
+    array, so each DP row is computed for a whole batch of queries in one
+    set of NumPy operations (batch_size queries at a time, grouped by
+    length to keep padding small).  Returns (best, optloc): an array of
+    best scores and an (n, 2) array of (i, j) end cells, identical to
+    what local_align gives for each query on its own."""
+    queries = list(queries)
+    n = len(queries)
+    best = np.zeros(n, dtype=_score_dtype(score))
+    optloc = np.zeros((n, 2), dtype=np.int64)
+    if n == 0 or len(template) == 0:
+        return best, optloc
+    if score.gap_start > 0 or score.gap > 0:
+        for b, q in enumerate(queries):
+            best[b], optloc[b] = local_align(q, template, score)[:2]
+        return best, optloc
+
+    ya = encode(template)
+    m = len(ya)
+    lens = np.array([len(q) for q in queries])
+    dtype = _batch_dtype(score, int(lens.max()), m)
+
+    # substitution rows for every byte value, padding byte 0 never matches
+    profile = np.full((256, m), score.mismatch, dtype=dtype)
+    for c in np.unique(ya):
+        if c:
+            profile[c, ya == c] = score.match
+
+    order = np.argsort(lens, kind="stable")
+    for start in range(0, n, batch_size):
+        idx = order[start:start + batch_size]
+        qa = _pad_queries([queries[b] for b in idx], lens[idx])
+        best[idx], optloc[idx] = _batch_fill(
+            qa, lens[idx], lambda i: profile[qa[:, i - 1]], m, score, dtype)
+
+    return best, optloc
+
+
+def local_align_windows(query, template, windows, score=ScoreParam(10, -5, -7),
+                        batch_size=256):
+    """Align one query against each window template[lo:hi] of windows.
+
+    The windows are the rows of a batch, so a scan over thousands of
+    candidate sites costs a few NumPy operations per query base.  Returns
+    (best, optloc) arrays with optloc in template coordinates, identical
+    to local_align(query, template[lo:hi]) for each window with the
+    column shifted by lo, and (0, 0) where nothing scores above zero."""
+    windows = list(windows)
+    n = len(windows)
+    best = np.zeros(n, dtype=_score_dtype(score))
+    optloc = np.zeros((n, 2), dtype=np.int64)
+    if n == 0 or len(query) == 0:
+        return best, optloc
+    if score.gap_start > 0 or score.gap > 0:
+        for w, (lo, hi) in enumerate(windows):
+            best[w], (i, j) = local_align(query, template[lo:hi], score)[:2]
+            optloc[w] = (i, j + lo)
+        return best, optloc
+
+    L = len(query)
+    match = score.match
+    for start in range(0, n, batch_size):
+        batch = windows[start:start + batch_size]
+        width = max(hi - lo for lo, hi in batch)
+        if width == 0:
+            continue
+        ta = np.zeros((len(batch), width), dtype=np.uint8)
+        valid = np.zeros((len(batch), width), dtype=bool)
+        for r, (lo, hi) in enumerate(batch):
+            ta[r, :hi - lo] = encode(template[lo:hi])
+            valid[r, :hi - lo] = True
+        dtype = _batch_dtype(score, L, width)
+        qa = _pad_queries([query] * len(batch), np.full(len(batch), L))
+        b, loc = _batch_fill(
+            qa, np.full(len(batch), L),
+            lambda i: np.where(ta == qa[:, i - 1, None], dtype.type(match),
+                               dtype.type(score.mismatch)),
+            width, score, dtype, valid)
+        best[start:start + len(batch)] = b
+        loc[:, 1] += np.array([lo for lo, hi in batch])
+        optloc[start:start + len(batch)] = np.where(b[:, None] > 0, loc, 0)
+    return best, optloc
+
+
+#=============================================================
+# Traceback
+#=============================================================
+
+class Alignment:
+    """A traced local alignment of x[x_start:x_end] against
+    y[y_start:y_end].  cigar uses M for an aligned pair (match or
+    mismatch), I for a base of x against a gap and D for a base of y
+    against a gap; aligned_x and aligned_y spell the alignment out with
+    '-' for gaps."""
+    def __init__(self, score, x_start, x_end, y_start, y_end, cigar,
+                 aligned_x, aligned_y):
+        self.score = score
+        self.x_start = x_start
+        self.x_end = x_end
+        self.y_start = y_start
+        self.y_end = y_end
+        self.cigar = cigar
+        self.aligned_x = aligned_x
+        self.aligned_y = aligned_y
+
+    def __repr__(self):
+        return "Alignment(score=%s, x=%d:%d, y=%d:%d, cigar=%s)" % (
+            self.score, self.x_start, self.x_end, self.y_start, self.y_end,
+            self.cigar)
+
+    def __str__(self):
+        bars = "".join("|" if a == b else " "
+                       for a, b in zip(self.aligned_x, self.aligned_y))
+        return "%s\n%s\n%s" % (self.aligned_x, bars, self.aligned_y)
+
+
+def traceback(x, y, best, optloc, score=ScoreParam(10, -5, -7)):
+    """Trace the alignment that local_align reported as (best, optloc).
+
+    Nothing is kept from the forward pass.  An alignment scoring best that
+    ends at (i, j) can use at most (match*i - best) / -gap gap columns in
+    x, so it starts within i + that many template columns of j.  Only that
+    window is refilled (with all three Gotoh states), so memory depends on
+    the query length and the score, never on the template length."""
+    i1, j1 = optloc
+    if best <= 0:
+        return Alignment(best, i1, i1, j1, j1, "", "", "")
+    if score.gap < 0:
+        slack = int((score.match * i1 - best) // -score.gap)
+        j0 = max(0, j1 - i1 - slack)
+    else:
+        j0 = 0
+    H, E, F = _fill_states(x[:i1], y[j0:j1], score)
+
+    def sub(i, j):
+        return score.match if x[i - 1] == y[j0 + j - 1] else score.mismatch
+
+    open_gap = score.gap_start + score.gap
+    i, j = i1, j1 - j0
+    state = "H"
+    ops = []
+    while True:
+        if state == "H":
+            if H[i][j] == 0:
+                break
+            if i > 0 and j > 0 and H[i][j] == H[i - 1][j - 1] + sub(i, j):
+                ops.append("M")
+                i, j = i - 1, j - 1
+            elif H[i][j] == F[i][j]:
+                state = "F"
+            else:
+                state = "E"
+        elif state == "F":
+            ops.append("I")
+            if F[i][j] == H[i - 1][j] + open_gap:
+                state = "H"
+            i -= 1
+        else:
+            ops.append("D")
+            if E[i][j] == H[i][j - 1] + open_gap:
+                state = "H"
+            j -= 1
+    ops.reverse()
+
+    aligned_x, aligned_y = [], []
+    xi, yj = i, j0 + j
+    for op in ops:
+        aligned_x.append(x[xi] if op in "MI" else "-")
+        aligned_y.append(y[yj] if op in "MD" else "-")
+        xi += op in "MI"
+        yj += op in "MD"
+    cigar = []
+    for op in ops:
+        if cigar and cigar[-1][1] == op:
+            cigar[-1][0] += 1
+        else:
+            cigar.append([1, op])
+    return Alignment(best, i, i1, j0 + j, j1,
+                     "".join("%d%s" % (n, op) for n, op in cigar),
+                     "".join(aligned_x), "".join(aligned_y))
+
+
+def _fill_states(x, y, score):
+    """Full H, E and F matrices of the Gotoh recurrence (E and F are -inf
+    style sentinels where no gap can end), row-vectorized as in
+    _local_align_numpy_affine.  With gap_start = 0 H is the local_align
+    matrix."""
+    n, m = len(x), len(y)
+    dtype = _score_dtype(score)
+    NEG = np.iinfo(dtype).min // 2 if dtype.kind == "i" else -np.inf
+    H = np.zeros((n + 1, m + 1), dtype=dtype)
+    E = np.full((n + 1, m + 1), NEG, dtype=dtype)
+    F = np.full((n + 1, m + 1), NEG, dtype=dtype)
+    if n == 0 or m == 0:
+        return H, E, F
+    xa, profile = query_profile(x, y, score)
+    jgap = np.arange(m + 1, dtype=dtype) * score.gap
+    open_gap = score.gap_start + score.gap
+    D = np.zeros(m + 1, dtype=dtype)
+    for i in range(1, n + 1):
+        np.maximum(F[i - 1] + score.gap, H[i - 1] + open_gap, out=F[i])
+        np.add(H[i - 1, :-1], profile[xa[i - 1]], out=D[1:])
+        np.maximum(D[1:], F[i, 1:], out=D[1:])
+        np.maximum(D[1:], 0, out=D[1:])
+        prefix = np.maximum.accumulate(D - jgap)
+        E[i, 1:] = prefix[:-1] + jgap[1:] + score.gap_start
+        np.maximum(D, E[i], out=H[i])
+        H[i, 0] = 0
+    return H, E, F
+
+
+def local_align_traceback(x, y, score=ScoreParam(10, -5, -7)):
+    """local_align followed by traceback: the optimal local alignment of
+    x against y as an Alignment, in linear memory."""
+    best, optloc, _ = local_align(x, y, score)
+    return traceback(x, y, best, optloc, score)
+
+
+#=============================================================
+# Alignment cache
+#=============================================================
+
+class AlignmentCache:
+    """Bounded LRU cache of local_align results and tracebacks.
+
+    Entries are keyed by (query, template, ScoreParam).  Templates are
+    compared by value, but a string caches its hash and equal-identity
+    keys compare without looking at the characters, so reusing the same
+    template object costs no more than keying on its id.  hits, misses
+    and evictions count lookups since the last clear()."""
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key, compute):
+        entries = self._entries
+        if key in entries:
+            self.hits += 1
+            entries.move_to_end(key)
+            return entries[key]
+        self.misses += 1
+        value = compute()
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def _align(self, x, y, score, index):
+        """Key and uncached computation of a local_align() entry."""
+        if index is not None:
+            return (("seeded", x, y, score, index.min_identity),
+                    lambda: index.align(x))
+        return ("align", x, y, score), lambda: local_align(x, y, score)[:2]
+
+    def local_align(self, x, y, score=ScoreParam(10, -5, -7), index=None):
+        """Cached local_align(x, y, score)[:2].  With index, a
+        TemplateIndex of y built with score, the result comes from
+        index.align(x) and is cached apart from the full scan: the same
+        whenever the alignment reaches index.min_identity, possibly lower
+        below it."""
+        return self._lookup(*self._align(x, y, score, index))
+
+    def traceback(self, x, y, score=ScoreParam(10, -5, -7), index=None):
+        """Cached local_align_traceback(x, y, score); index as for
+        local_align().  A cached score and end cell is reused if there is
+        one, without counting as a lookup, so a cold call is one miss and
+        one entry."""
+        key, align = self._align(x, y, score, index)
+        def compute():
+            best, optloc = self._entries.get(key) or align()
+            return traceback(x, y, best, optloc, score)
+        if index is not None:
+            return self._lookup(("seeded traceback", x, y, score,
+                                 index.min_identity), compute)
+        return self._lookup(("traceback", x, y, score), compute)
+
+    def resize(self, maxsize):
+        """Change the bound, evicting the least recently used entries."""
+        self.maxsize = maxsize
+        while len(self._entries) > maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "%d/%d entries; hits = %d; misses = %d; evictions = %d" % (
+            len(self._entries), self.maxsize, self.hits, self.misses,
+            self.evictions)
+
+
+#=============================================================
+# Banded and X-drop variants
+#=============================================================
+
+def local_align_banded(x, y, center, band, score=ScoreParam(10, -5, -7)):
+    """Local alignment restricted to the diagonals j - i within band of
+    center, where cell (i, j) pairs x[:i] with y[:j].  Costs
+    O(len(x)*band) instead of O(len(x)*len(y)).  Returns (best, optloc)
+    in the coordinates of the full matrix; when the optimal alignment of
+    local_align lies inside the band the results are identical.  Assumes
+    non-positive gap penalties."""
+    n, m = len(x), len(y)
+    xa = encode(x)
+    ya = encode(y)
+    dtype = _score_dtype(score)
+    NEG = np.iinfo(dtype).min // 2 if dtype.kind == "i" else -np.inf
+    W = 2 * band + 1
+    lo = center - band
+    kgap = np.arange(W, dtype=dtype) * score.gap
+    open_gap = score.gap_start + score.gap
+    k = np.arange(W)
+
+    # band position k of row i is column j = i + lo + k; the diagonal
+    # neighbour of a cell keeps k, the cell above moves to k + 1
+    prev = np.zeros(W + 1, dtype=dtype)
+    F = np.full(W + 1, NEG, dtype=dtype)
+    row = np.zeros(W + 1, dtype=dtype)
+    row[W] = NEG
+    D = np.empty(W, dtype=dtype)
+    E = np.empty(W, dtype=dtype)
+
+    best = 0
+    optloc = (0,0)
+    for i in range(1, n + 1):
+        j = i + lo + k
+        inside = (j >= 1) & (j <= m)
+        if not inside.any():
+            if j[0] > m:
+                break
+            prev[:W] = 0
+            F[:W] = NEG
+            continue
+        sub = np.where(ya[np.clip(j - 1, 0, m - 1)] == xa[i - 1],
+                       score.match, score.mismatch)
+        np.add(prev[:W], sub, out=D)
+        if score.gap_start:
+            F[:W] = np.maximum(F[1:] + score.gap, prev[1:] + open_gap)
+            np.maximum(D, F[:W], out=D)
+        else:
+            np.maximum(D, prev[1:] + score.gap, out=D)
+        np.maximum(D, 0, out=D)
+        # cells outside the matrix behave like the zero border
+        D[~inside] = 0
+        np.subtract(D, kgap, out=E)
+        np.maximum.accumulate(E, out=E)
+        if score.gap_start:
+            np.add(E[:-1], kgap[1:] + score.gap_start, out=row[1:W])
+            row[0] = NEG
+            np.maximum(row[:W], D, out=row[:W])
+        else:
+            np.add(E, kgap, out=row[:W])
+
+        cells = np.where(inside, row[:W], NEG)
+        rowbest = cells.max()
+        if rowbest >= best:
+            best = rowbest.item()
+            optloc = (i, int(j[_last_argmax(cells)]))
+        prev, row = row, prev
+
+    return best, optloc
+
+
+def local_align_xdrop(x, y, start, xdrop, score=ScoreParam(10, -5, -7)):
+    """Local alignment of x against y[start:], extended one template
+    column at a time and abandoned once a whole column scores more than
+    xdrop below the best cell so far.  Returns (best, optloc) in the
+    coordinates of the full matrix, with the same tie-breaking as
+    local_align.  Assumes non-positive gap penalties."""
+    n, m = len(x), len(y)
+    xa = encode(x)
+    ya = encode(y)
+    dtype = _score_dtype(score)
+    NEG = np.iinfo(dtype).min // 2 if dtype.kind == "i" else -np.inf
+    igap = np.arange(n + 1, dtype=dtype) * score.gap
+    open_gap = score.gap_start + score.gap
+    profile = {}
+
+    # the transpose of the row sweep in _local_align_numpy_affine: columns
+    # run along x, the gap state carried between them is a gap in x
+    prev = np.zeros(n + 1, dtype=dtype)
+    col = np.zeros(n + 1, dtype=dtype)
+    gapx = np.full(n + 1, NEG, dtype=dtype)
+    D = np.zeros(n + 1, dtype=dtype)
+    E = np.empty(n + 1, dtype=dtype)
+
+    best = 0
+    optloc = (0,0)
+    if n == 0:
+        return best, optloc
+    for j in range(start + 1, m + 1):
+        c = ya[j - 1]
+        if c not in profile:
+            profile[c] = np.where(xa == c, score.match, score.mismatch)
+        np.add(prev[:-1], profile[c], out=D[1:])
+        if score.gap_start:
+            gapx += score.gap
+            np.maximum(gapx, prev + open_gap, out=gapx)
+            np.maximum(D[1:], gapx[1:], out=D[1:])
+        else:
+            np.maximum(D[1:], prev[1:] + score.gap, out=D[1:])
+        np.maximum(D[1:], 0, out=D[1:])
+        np.subtract(D, igap, out=E)
+        np.maximum.accumulate(E, out=E)
+        if score.gap_start:
+            np.add(E[:-1], igap[1:] + score.gap_start, out=col[1:])
+            np.maximum(col, D, out=col)
+        else:
+            np.add(E, igap, out=col)
+
+        # row-major order: a later row beats a later column
+        colbest = col[1:].max()
+        i = _last_argmax(col[1:]) + 1
+        if (colbest, i, j) >= (best,) + optloc:
+            best = colbest.item()
+            optloc = (i, j)
+        if best > 0 and colbest < best - xdrop:
+            break
+        prev, col = col, prev
+
+    return best, optloc
+
+
+#=============================================================
+# Seed-and-extend over a k-mer index
+#=============================================================
+
+@functools.lru_cache(maxsize=None)
+def seed_filter(qlen, score, min_identity=0.8):
+    """Choose a seed length k and a hit count h for a query of length qlen.
+
+    Any local alignment scoring at least min_identity*match*qlen is a
+    chain of exactly matching runs separated by mismatches and gaps.  With
+    e such events and a matched bases, the runs contain at least
+    a - (e+1)*(k-1) exact k-mer hits, all on diagonals within `spread` of
+    each other (spread bounds the number of gap columns).  Minimising over
+    every alignment that can still reach the threshold gives h, so a
+    diagonal band holding fewer than h hits cannot contain a binding site.
+
+    Returns (k, h, spread), or None if the scoring parameters give no
+    usable guarantee (in which case callers scan the whole template)."""
+    M, X = score.match, score.mismatch
+    g, o = score.gap, score.gap_start
+    if not (M > 0 and X < M and g < 0 and o <= 0) or qlen == 0:
+        return None
+    target = min_identity * M * qlen - 1e-9
+    spread = int((M * qlen - target) // -g)
+
+    # worst cases: every mismatch and gap is its own one-column event
+    events = []
+    for b in range(qlen + 1):
+        for q in range(qlen + 1 - b):
+            for t in range(spread + 1):
+                a = math.ceil((target - X * b - (g + o) * (q + t)) / M)
+                if a + b + q > qlen:
+                    break
+                events.append((max(a, 0), b + q + t))
+    if not events:
+        return None
+
+    choice = None
+    for k in range(1, 9):
+        h = min(a - (e + 1) * (k - 1) for a, e in events)
+        if h < 1:
+            break
+        # expected chance hits in one band for a uniform ACGT template
+        expected = (spread + 1) * qlen / 4.0**k
+        merit = (h - expected) / math.sqrt(expected)
+        if choice is None or merit > choice[0]:
+            choice = (merit, k, h)
+    if choice is None:
+        return None
+    return choice[1], choice[2], spread
+
+
+class TemplateIndex:
+    """k-mer index over one template for seed-and-extend primer binding.
+
+    Build it once per template; align() then only runs the DP in small
+    windows around diagonal bands with enough exact k-mer hits to hold an
+    alignment that reaches min_identity (see seed_filter).  Whenever the
+    true best score reaches min_identity*match*len(query), align() returns
+    exactly what local_align(query, template, score)[:2] would, including
+    the tie-breaking.  Below the threshold it may report a lower score.
+
+    This is a filter, not a large speedup on the assignment's templates:
+    the guarantee needs 3-mer seeds at 80% identity, which a 16S sequence
+    of 1.5 kb matches often enough that the windows still cover about a
+    sixth of it, and the DP there is dominated by per-row overhead.  On
+    those templates align() is on par with local_align() and align_many()
+    is about 1.2x faster than local_align_many(); the gains only grow on
+    long templates with few chance hits."""
+
+    def __init__(self, template, score=ScoreParam(10, -5, -7),
+                 min_identity=0.8):
+        self.template = template
+        self.ya = encode(template)
+        self.score = score
+        self.min_identity = min_identity
+        self._kmers = {}
+
+    def kmers(self, k):
+        """(sorted k-mer codes, their template positions) for length k."""
+        if k not in self._kmers:
+            codes = _kmer_codes(self.ya, k)
+            order = np.argsort(codes, kind="stable")
+            self._kmers[k] = (codes[order], order)
+        return self._kmers[k]
+
+    def windows(self, query):
+        """Merged [start, end) template windows that may hold a binding
+        site, or None when the whole template has to be scanned."""
+        return self.windows_many([query])[0]
+
+    def windows_many(self, queries):
+        """windows() for a list of queries, with the seed lookup and band
+        counting vectorized over all queries of the same length."""
+        result = [None] * len(queries)
+        m = len(self.ya)
+        by_length = {}
+        for q, query in enumerate(queries):
+            by_length.setdefault(len(query), []).append(q)
+
+        for L, members in by_length.items():
+            params = seed_filter(L, self.score, self.min_identity)
+            if params is None or L < params[0]:
+                continue
+            k, h, spread = params
+            for q in members:
+                result[q] = []
+            qcodes = _kmer_codes(np.stack([encode(queries[q])
+                                           for q in members]), k)
+            nk = qcodes.shape[1]
+
+            codes, positions = self.kmers(k)
+            flat = qcodes.ravel()
+            lo = np.searchsorted(codes, flat, side="left")
+            counts = np.searchsorted(codes, flat, side="right") - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                                   counts)
+            tpos = positions[np.repeat(lo, counts) + offsets]
+            slot = np.repeat(np.arange(len(flat)), counts)
+            # one block of diagonals per query, far enough apart that a band
+            # never reaches into the next query's block
+            stride = m + L + spread + 1
+            keys = np.sort((slot // nk) * stride + (tpos - slot % nk) + L)
+
+            # bands [d, d + spread] starting at a hit with at least h hits
+            ends = np.searchsorted(keys, keys + spread, side="right")
+            starts = np.unique(keys[ends - np.arange(total) >= h])
+            if len(starts) == 0:
+                continue
+            base = starts - starts % stride
+            d = starts - base - L
+            wlo = base + np.maximum(d - spread, 0)
+            whi = base + np.minimum(d + spread + L, m)
+            # starts are sorted, so a window opens wherever its start passes
+            # every earlier end
+            reach = np.maximum.accumulate(whi)
+            opens = np.ones(len(wlo), dtype=bool)
+            opens[1:] = wlo[1:] > reach[:-1]
+            first = np.flatnonzero(opens)
+            last = np.append(first[1:], len(wlo)) - 1
+            for f, l in zip(first.tolist(), last.tolist()):
+                q = members[int(starts[f] // stride)]
+                result[q].append((int(wlo[f] - base[f]),
+                                  int(reach[l] - base[f])))
+        return result
+
+    def _concatenate(self, windows, qlen):
+        """Join the windows of one query with separators no alignment can
+        cross: a diagonal step into a separator scores below anything the
+        query can reach, and a gap chain through one costs more than that.
+        Returns (bytes, offset of each window, template start of each)."""
+        top = self.score.match * qlen
+        sep = int(top // -self.score.gap) + 1
+        pieces, offsets = [], []
+        offset = 0
+        for lo, hi in windows:
+            offsets.append(offset)
+            pieces.append(self.ya[lo:hi])
+            pieces.append(np.zeros(sep, dtype=np.uint8))
+            offset += hi - lo + sep
+        return (np.concatenate(pieces[:-1]), np.array(offsets),
+                np.array([lo for lo, hi in windows]))
+
+    def align(self, query):
+        """Best score and end cell of query against the template, in
+        template coordinates (see the class docstring for exactness)."""
+        windows = self.windows(query)
+        if windows is None:
+            return local_align(query, self.template, self.score)[:2]
+        if not windows:
+            return 0, (0, 0)
+
+        score = self.score
+        y, offsets, lows = self._concatenate(windows, len(query))
+        profile = {}
+        for c in np.unique(encode(query)):
+            row = np.where(y == c, score.match, score.mismatch)
+            row[y == 0] = -score.match * len(query) - 1
+            profile[c] = row
+        best, (i, j), _ = _local_align_numpy(
+            query, y, score, keep_matrix=False, profile=profile)
+        if best <= 0:
+            return 0, (0, 0)
+        # map the concatenated column back into template coordinates
+        w = np.searchsorted(offsets, j - 1, side="right") - 1
+        return best, (i, int(j - offsets[w] + lows[w]))
+
+    def align_many(self, queries, batch_size=64):
+        """align() for many queries, returned as (best, optloc) arrays like
+        local_align_many.  The windows of each query are concatenated and
+        a batch of queries is filled together."""
+        queries = list(queries)
+        n = len(queries)
+        score = self.score
+        best = np.zeros(n, dtype=_score_dtype(score))
+        optloc = np.zeros((n, 2), dtype=np.int64)
+        windows = self.windows_many(queries)
+
+        full = [q for q in range(n) if windows[q] is None]
+        if full:
+            best[full], optloc[full] = local_align_many(
+                [queries[q] for q in full], self.template, score)
+        todo = [q for q in range(n) if windows[q]]
+        joined = {q: self._concatenate(windows[q], len(queries[q]))
+                  for q in todo}
+        # batch queries with similar amounts of window to keep padding small
+        todo.sort(key=lambda q: len(joined[q][0]))
+
+        for start in range(0, len(todo), batch_size):
+            idx = todo[start:start + batch_size]
+            lens = np.array([len(queries[q]) for q in idx])
+            width = max(len(joined[q][0]) for q in idx)
+            ta = np.zeros((len(idx), width), dtype=np.uint8)
+            valid = np.zeros((len(idx), width), dtype=bool)
+            for r, q in enumerate(idx):
+                y = joined[q][0]
+                ta[r, :len(y)] = y
+                valid[r, :len(y)] = True
+            dtype = _batch_dtype(score, int(lens.max()), width)
+            # separators and padding score below any alignment
+            background = np.where(ta == 0, -score.match * lens[:, None] - 1,
+                                  score.mismatch).astype(dtype)
+            match = dtype.type(score.match)
+            qa = _pad_queries([queries[q] for q in idx], lens)
+            b, loc = _batch_fill(
+                qa, lens,
+                lambda i: np.where(ta == qa[:, i - 1, None], match,
+                                   background),
+                width, score, dtype, valid)
+
+            for r, q in enumerate(idx):
+                if b[r] <= 0:
+                    continue
+                y, offsets, lows = joined[q]
+                i, j = loc[r]
+                w = np.searchsorted(offsets, j - 1, side="right") - 1
+                best[q] = b[r]
+                optloc[q] = (i, j - offsets[w] + lows[w])
+        return best, optloc
+
+
+def _kmer_codes(a, k):
+    """Integer code of every k-mer along the last axis of the uint8 array
+    a.  Only the first eight bytes take part, so longer k-mers may share a
+    code; that only adds candidate hits and never loses one."""
+    if a.shape[-1] < k:
+        return np.zeros(a.shape[:-1] + (0,), dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(a, k, axis=-1)
+    codes = np.zeros(windows.shape[:-1], dtype=np.uint64)
+    for c in range(min(k, 8)):
+        codes = (codes << np.uint64(8)) | windows[..., c].astype(np.uint64)
+    return codes
+
+
+#=============================================================
+# Bit-parallel binding filter
+#=============================================================
+
+@functools.lru_cache(maxsize=None)
+def edit_bound(qlen, score, min_identity=0.8):
+    """Most edits a query of length qlen can have against a template
+    substring and still align locally with at least min_identity*match*qlen.
+
+    Edits are mismatches, gap columns and query bases left out of the
+    local alignment; each one costs at least the cheapest of match -
+    mismatch, -gap and match below a perfect score, and only
+    (1 - min_identity)*match*qlen can be lost.  Returns None if the
+    scoring parameters give no such bound."""
+    M, X = score.match, score.mismatch
+    g, o = score.gap, score.gap_start
+    if not (M > 0 and X < M and g < 0 and o <= 0) or qlen == 0:
+        return None
+    target = min_identity * M * qlen - 1e-9
+    return int((M * qlen - target) // min(M - X, -g, M))
+
+
+def may_bind_many(queries, template, score=ScoreParam(10, -5, -7),
+                  min_identity=0.8):
+    """Screen queries for local_align(query, template)[0] reaching
+    min_identity*match*len(query), without running the DP.
+
+    Myers' bit-vector algorithm tracks, for every template position, the
+    fewest edits between the whole query and a template substring ending
+    there, with one bit per query base in a 64-bit word; the queries run
+    side by side in uint64 arrays, so a batch costs O(len(template))
+    vector steps.  A query that never gets within edit_bound edits cannot
+    reach the score, so False is definite and True means the DP has to
+    decide (no false negatives).  Queries longer than 64 bases, and scores
+    without a bound, always pass."""
+    queries = list(queries)
+    result = np.ones(len(queries), dtype=bool)
+    todo = [q for q, query in enumerate(queries)
+            if 0 < len(query) <= 64
+            and edit_bound(len(query), score, min_identity) is not None]
+    ya = encode(template)
+    if not todo or len(ya) == 0:
+        return result
+    lens = np.array([len(queries[q]) for q in todo])
+    bound = np.array([edit_bound(int(L), score, min_identity) for L in lens])
+    qa = _pad_queries([queries[q] for q in todo], lens)
+
+    # Peq[c]: bit i set where query base i is c
+    bits = np.uint64(1) << np.arange(qa.shape[1], dtype=np.uint64)
+    peq = np.zeros((256, len(todo)), dtype=np.uint64)
+    for c in np.unique(qa):
+        if c:
+            peq[c] = np.bitwise_or.reduce(np.where(qa == c, bits, np.uint64(0)), axis=1)
+    mask = np.array([(1 << int(L)) - 1 for L in lens], dtype=np.uint64)
+    high = np.array([1 << (int(L) - 1) for L in lens], dtype=np.uint64)
+    one = np.uint64(1)
+
+    # column 0: the empty substring is len(query) deletions away
+    Pv = mask.copy()
+    Mv = np.zeros(len(todo), dtype=np.uint64)
+    edits = lens.astype(np.int64)
+    passed = edits <= bound
+    for c in ya:
+        Eq = peq[c]
+        Xv = Eq | Mv
+        Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+        Ph = Mv | ~(Xh | Pv)
+        Mh = Pv & Xh
+        edits += (Ph & high) != 0
+        edits -= (Mh & high) != 0
+        passed |= edits <= bound
+        # a substring may start anywhere, so nothing enters at row 0
+        Ph = (Ph << one) & mask
+        Mh = (Mh << one) & mask
+        Pv = Mh | (~(Xv | Ph) & mask)
+        Mv = Ph & Xv
+    result[todo] = passed
+    return result
+
+
+def check_engines(trials=300, seed=0):
+    """Regression check: compare the NumPy engines against the reference
+    loops on random sequences, and check that the affine engine with
+    gap_start = 0 reproduces the linear-gap results exactly."""
+    import random
+    rng = random.Random(seed)
+    params = [ScoreParam(10, -5, -7), ScoreParam(2, -1, -1),
+              ScoreParam(3, -2, -10), ScoreParam(10, -5, -7, -10),
+              ScoreParam(5, -4, -1, -6)]
+    for _ in range(trials):
+        x = "".join(rng.choice("ACGT") for _ in range(rng.randint(0, 15)))
+        y = "".join(rng.choice("ACGTN") for _ in range(rng.randint(0, 40)))
+        for score in params:
+            ref = _local_align_python(x, y, score)
+            fast = _local_align_numpy(x, y, score)
+            assert ref[:2] == fast[:2], (x, y, str(score), ref[:2], fast[:2])
+            assert (np.array(ref[2]) == fast[2]).all(), (x, y, str(score))
+            if not score.gap_start:
+                affine = _local_align_numpy_affine(x, y, score)
+                assert affine[:2] == fast[:2], (x, y, str(score))
+                assert (affine[2] == fast[2]).all(), (x, y, str(score))
+    for score in params:
+        y = "".join(rng.choice("ACGTN") for _ in range(60))
+        qs = ["".join(rng.choice("ACGT") for _ in range(rng.randint(0, 15)))
+              for _ in range(50)]
+        best, optloc = local_align_many(qs, y, score, batch_size=16)
+        for q, b, loc in zip(qs, best, optloc):
+            ref = local_align(q, y, score)
+            assert ref[:2] == (b, tuple(loc)), (q, y, str(score))
+        windows = [(lo, rng.randint(lo, len(y))) for lo in
+                   (rng.randint(0, len(y)) for _ in range(20))]
+        best, optloc = local_align_windows(qs[0] or "A", y, windows, score, batch_size=8)
+        for (lo, hi), b, loc in zip(windows, best, optloc):
+            ref, (i, j), _ = local_align(qs[0] or "A", y[lo:hi], score)
+            assert (ref, (i, j + lo) if ref > 0 else (0, 0)) == (b, tuple(loc))
+    score = ScoreParam(10, -5, -7)
+    template = "".join(rng.choice("ACGT") for _ in range(400))
+    index = TemplateIndex(template, score)
+    queries = []
+    for _ in range(trials):
+        L = rng.randint(18, 35)
+        start = rng.randrange(len(template) - L)
+        q = list(template[start:start + L])
+        for _ in range(rng.randint(0, 4)):
+            pos = rng.randrange(len(q))
+            op = rng.choice("sdi")
+            if op == "s":
+                q[pos] = rng.choice("ACGT")
+            elif op == "d":
+                del q[pos]
+            else:
+                q.insert(pos, rng.choice("ACGT"))
+        q = "".join(q)
+        ref = local_align(q, template, score)[:2]
+        queries.append(q)
+        if ref[0] >= 0.8 * score.match * len(q):
+            assert index.align(q) == ref, (q, ref, index.align(q))
+    best, optloc = index.align_many(queries, batch_size=16)
+    for q, b, loc in zip(queries, best, optloc):
+        ref = local_align(q, template, score)[:2]
+        if ref[0] >= 0.8 * score.match * len(q):
+            assert ref == (b, tuple(loc)), (q, ref, b, loc)
+    for _ in range(trials):
+        score = rng.choice(params)
+        x = "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 15)))
+        y = "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 40)))
+        ref = local_align(x, y, score)[:2]
+        # a band or X-drop covering everything is the full alignment
+        wide = local_align_banded(x, y, 0, len(x) + len(y), score)
+        assert wide == ref, (x, y, str(score), ref, wide)
+        assert local_align_xdrop(x, y, 0, 10**9, score) == ref
+        center, band = rng.randint(-10, 30), rng.randint(0, 6)
+        banded = local_align_banded(x, y, center, band, score)
+        assert banded[0] <= ref[0]
+        # the band holds the optimal path iff it holds every diagonal
+        # j - i the traceback passes through
+        if ref[0] > 0:
+            diagonals = _path_diagonals(traceback(x, y, ref[0], ref[1], score))
+            if center - band <= min(diagonals) and max(diagonals) <= center + band:
+                assert banded == ref, (x, y, str(score), center, band, ref, banded)
+        # a planted exact hit is the optimum, and lies in its own band
+        start = rng.randrange(len(template) - 30)
+        q = template[start:start + rng.randint(18, 30)]
+        ref = local_align(q, template, score)[:2]
+        assert local_align_banded(q, template, start, 3, score) == ref
+        assert local_align_xdrop(q, template, max(start - 5, 0), 40,
+                                 score) == ref
+    for _ in range(trials):
+        score = rng.choice(params)
+        x = "".join(rng.choice("ACGT") for _ in range(rng.randint(0, 15)))
+        y = "".join(rng.choice("ACGT") for _ in range(rng.randint(0, 60)))
+        best, optloc, _ = local_align(x, y, score)
+        aln = traceback(x, y, best, optloc, score)
+        assert (aln.x_end, aln.y_end) == optloc
+        assert aln.aligned_x.replace("-", "") == x[aln.x_start:aln.x_end]
+        assert aln.aligned_y.replace("-", "") == y[aln.y_start:aln.y_end]
+        # rescore the traced columns
+        total, gap = 0, None
+        for a, b in zip(aln.aligned_x, aln.aligned_y):
+            if "-" in (a, b):
+                total += score.gap + (score.gap_start if gap != (a == "-")
+                                      else 0)
+                gap = a == "-"
+            else:
+                total += score.matchchar(a, b)
+                gap = None
+        assert total == best, (x, y, str(score), aln, total)
+    for score in params:
+        y = "".join(rng.choice("ACGTN") for _ in range(120))
+        qs = []
+        for _ in range(trials // 3):
+            start = rng.randrange(100)
+            q = list(y[start:start + rng.randint(1, 30)])
+            for _ in range(rng.randint(0, 5)):
+                q[rng.randrange(len(q))] = rng.choice("ACGT")
+            qs.append("".join(q))
+        for q, ok in zip(qs, may_bind_many(qs, y, score)):
+            best = local_align(q, y, score)[0]
+            assert ok or best < 0.8 * score.match * len(q), (q, y, str(score))
+    # a cold traceback is one miss and one entry
+    cache = AlignmentCache()
+    aln = cache.traceback("ACGTACGT", "TTACGTACGTTT")
+    assert (cache.misses, len(cache), aln.y_start) == (1, 1, 2), str(cache)
+    cache.local_align("ACGT", "TTACGT")
+    cache.traceback("ACGT", "TTACGT")
+    assert (cache.hits, cache.misses, len(cache)) == (0, 3, 3), str(cache)
+    print("check_engines: %d random cases OK" % trials)
+
+
+def _path_diagonals(aln):
+    """Diagonals j - i of the cells an Alignment's path visits."""
+    i, j = aln.x_start, aln.y_start
+    diagonals = [j - i]
+    for a, b in zip(aln.aligned_x, aln.aligned_y):
+        i += a != "-"
+        j += b != "-"
+        diagonals.append(j - i)
+    return diagonals
+
+
+if __name__ == "__main__":
+    #local_align("ACTG", "ACTGACTGACTG", score=ScoreParam(10, -5, -7))
+    check_engines()
\ No newline at end of file
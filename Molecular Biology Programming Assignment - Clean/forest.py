@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Flattened random forests: a trained sklearn RandomForestRegressor copied
+into contiguous NumPy arrays, for low-latency prediction without sklearn.
+"""
+
+import numpy as np
+
+
+class FlatForest:
+    """All trees of a regression forest in flat arrays.
+
+    Node n of the forest tests X[:, feature[n]] <= threshold[n] and moves
+    to left[n] or right[n] (global node indices); leaves point to
+    themselves and predict value[n].  roots holds the first node of every
+    tree, depth the deepest leaf and n_features the width of the rows
+    the forest was fitted on.  predict() walks every tree at once,
+    one level per step, and averages the leaves in the same order and
+    precision as sklearn, so its output is bit-identical to
+    RandomForestRegressor.predict with the default n_jobs.
+
+    Works as a drop-in melting_point_rf.  A single row costs a few hundred
+    microseconds against sklearn's ~20 ms; for many thousands of rows
+    sklearn's compiled traversal is still faster."""
+    def __init__(self, feature, threshold, left, right, value, roots, depth,
+                 n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.n_features = n_features
+        self._fingerprint = None
+
+    @classmethod
+    def from_sklearn(cls, rf):
+        """Flatten a fitted single-output RandomForestRegressor."""
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in rf.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count) + offset
+            leaf = tree.children_left == -1
+            roots.append(offset)
+            feature.append(np.maximum(tree.feature, 0))
+            threshold.append(tree.threshold)
+            left.append(np.where(leaf, nodes, tree.children_left + offset))
+            right.append(np.where(leaf, nodes, tree.children_right + offset))
+            value.append(tree.value[:, 0, 0])
+            offset += tree.node_count
+        return cls(np.concatenate(feature).astype(np.intp),
+                   np.concatenate(threshold).astype(np.float64),
+                   np.concatenate(left).astype(np.intp),
+                   np.concatenate(right).astype(np.intp),
+                   np.concatenate(value).astype(np.float64),
+                   np.array(roots, dtype=np.intp),
+                   max(e.tree_.max_depth for e in rf.estimators_),
+                   rf.n_features_in_)
+
+    def apply(self, X):
+        """Leaf index reached in every tree, as a (trees, rows) array."""
+        X = self._check(X)
+        flat = X.ravel()
+        base = np.arange(X.shape[0]) * X.shape[1]
+        node = np.repeat(self.roots[:, None], X.shape[0], axis=1)
+        for _ in range(self.depth):
+            go_left = flat[base + self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return node
+
+    def _check(self, X):
+        # sklearn compares float32 features against float64 thresholds
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        # nodes index the flattened rows, so a wrong width would not fail
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("X has %d features, but FlatForest is expecting %d features as input"
+                             % (X.shape[-1], self.n_features))
+        return X
+
+    def predict(self, X, rows=4096):
+        """Mean leaf value over the trees for each row of X.  Repeated
+        rows (common with sequence composition features) are predicted
+        once, and large inputs are walked `rows` at a time."""
+        X = self._check(X)
+        inverse = np.arange(len(X))
+        if len(X) > 64:
+            X, inverse = np.unique(X, axis=0, return_inverse=True)
+        y = np.zeros(len(X))
+        for first in range(0, len(X), rows):
+            leaves = self.value[self.apply(X[first:first + rows])]
+            # accumulate tree by tree, as sklearn does, for identical rounding
+            for tree_values in leaves:
+                y[first:first + rows] += tree_values
+        y /= len(self.roots)
+        return y[inverse.ravel()]
+
+    def fingerprint(self):
+        """Short hash of the trees, the same for every copy of the forest."""
+        if self._fingerprint is None:
+            import hashlib
+            digest = hashlib.sha1(np.int64([self.depth, self.n_features]).tobytes())
+            for array in (self.feature, self.threshold, self.left, self.right,
+                          self.value, self.roots):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()[:16]
+        return self._fingerprint
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold,
+                 left=self.left, right=self.right, value=self.value,
+                 roots=self.roots, depth=self.depth, n_features=self.n_features)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["feature"], data["threshold"], data["left"],
+                       data["right"], data["value"], data["roots"],
+                       int(data["depth"]), int(data["n_features"]))
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __repr__(self):
+        return "FlatForest(%d trees, %d nodes)" % (len(self.roots), len(self.value))
+
+
+def check_forest(rf, X):
+    """Regression check: the flattened rf must predict X bit-identically
+    to sklearn, row by row and after a save/load round trip, and reject
+    rows of the wrong width as sklearn does."""
+    import os
+    import tempfile
+
+    flat = FlatForest.from_sklearn(rf)
+    expected = rf.predict(X)
+    assert np.array_equal(flat.predict(X), expected)
+    for row, y in zip(X[:50], expected):
+        assert flat.predict(row)[0] == y
+    with tempfile.TemporaryDirectory() as tmp:
+        flat.save(os.path.join(tmp, "forest.npz"))
+        loaded = FlatForest.load(os.path.join(tmp, "forest.npz"))
+    assert np.array_equal(loaded.predict(X), expected)
+    try:
+        flat.predict(X[:, 1:])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("predict accepted rows of the wrong width")
+    print("check_forest: %r matches sklearn on %d rows" % (flat, len(X)))
+    return flat
+
+
+if __name__ == "__main__":
+    from sklearn.ensemble import RandomForestRegressor
+
+    # primer-like features: length and base counts
+    rng = np.random.default_rng(0)
+    X = rng.integers(0, 12, size=(2000, 5)).astype(float)
+    X[:, 0] = X[:, 1:].sum(axis=1)
+    y = 2 * X[:, 3] + 2 * X[:, 4] + rng.normal(0, 1, len(X))
+    check_forest(RandomForestRegressor(n_estimators=200).fit(X[::2], y[::2]), X)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight instrumentation for the PCR scripts: named counters,
+per-stage timers, periodic throughput samples and optional cProfile per
+stage, written out as a JSON summary or a Chrome trace
+(chrome://tracing, Perfetto).  Everything is off until enabled, and a
+disabled recorder costs one attribute test per call.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+
+class _SavedProfile:
+    """A profile's stats dict in the shape pstats.Stats loads from."""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Recorder:
+    """Counters, stage timers and throughput samples for one process.
+
+    count(name, n) adds to a counter, stage(name) times a with block
+    (and records it as a trace event and, with profile, under cProfile),
+    sample(name, total) notes a running total at most every interval
+    seconds.  Worker processes hand their records to the parent with
+    drain() and merge()."""
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.profile = False
+        self.interval = 1.0
+        self._profiling = False
+        self.reset()
+
+    def enable(self, trace=False, profile=False, interval=1.0):
+        """Start recording; trace keeps every stage as a trace event,
+        profile runs each outermost stage under cProfile."""
+        self.enabled = True
+        self.trace = trace
+        self.profile = profile
+        self.interval = interval
+        return self
+
+    def disable(self):
+        self.enabled = False
+
+    def options(self):
+        """enable() arguments reproducing this recorder's settings, for
+        worker processes, or None when disabled."""
+        if not self.enabled:
+            return None
+        return {"trace": self.trace, "profile": self.profile, "interval": self.interval}
+
+    def reset(self):
+        """Drop everything recorded so far."""
+        self.counters = {}
+        self.stages = {}
+        self.samples = {}
+        self.events = []
+        self.profiles = {}
+        self._last_sample = {}
+        self._started = time.perf_counter()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stage(self, name):
+        """Context manager timing its block as stage name."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        profiler = None
+        # cProfile allows one active profiler, so nested stages run
+        # inside their parent's profile
+        if self.profile and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                self._add_profile(name, profiler)
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+            if self.trace:
+                self.events.append({"name": name, "ph": "X", "ts": start * 1e6,
+                                    "dur": seconds * 1e6, "pid": os.getpid(),
+                                    "tid": threading.get_ident()})
+
+    def _add_profile(self, name, profile):
+        if name in self.profiles:
+            self.profiles[name].add(profile)
+        else:
+            self.profiles[name] = pstats.Stats(profile)
+
+    def sample(self, name, total):
+        """Record the running total of name (items done so far), at most
+        once per interval seconds; summary() turns samples into rates."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if now - self._last_sample.get(name, -self.interval) < self.interval:
+            return
+        self._last_sample[name] = now
+        self.samples.setdefault(name, []).append((now, total))
+        if self.trace:
+            self.events.append({"name": name, "ph": "C", "ts": now * 1e6,
+                                "pid": os.getpid(), "args": {name: total}})
+
+    def drain(self):
+        """Everything recorded since the last drain, as a picklable dict
+        for merge(), and a fresh start."""
+        drained = {"counters": self.counters, "stages": self.stages,
+                   "events": self.events,
+                   "profiles": {name: stats.stats for name, stats in self.profiles.items()}}
+        started = self._started
+        self.reset()
+        self._started = started
+        return drained
+
+    def merge(self, drained):
+        """Add the records of another process (see drain())."""
+        for name, n in drained["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, (calls, seconds) in drained["stages"].items():
+            old_calls, old_seconds = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (old_calls + calls, old_seconds + seconds)
+        self.events += drained["events"]
+        for name, stats in drained["profiles"].items():
+            self._add_profile(name, _SavedProfile(stats))
+
+    def summary(self):
+        """Counters, stage calls and seconds (summed over processes), and
+        throughput in items per second between consecutive samples."""
+        throughput = {}
+        for name, points in self.samples.items():
+            throughput[name] = [
+                {"seconds": round(t1 - self._started, 3), "total": n1,
+                 "per_second": (n1 - n0) / (t1 - t0)}
+                for (t0, n0), (t1, n1) in zip(points, points[1:]) if t1 > t0]
+        return {"wall_seconds": time.perf_counter() - self._started,
+                "counters": dict(self.counters),
+                "stages": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in self.stages.items()},
+                "throughput": throughput}
+
+    def save_summary(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.summary(), outfile, indent=2)
+
+    def save_trace(self, path):
+        """Write the trace events (enable(trace=True)) in Chrome's trace
+        event format; timestamps are microseconds on perf_counter."""
+        with open(path, "w") as outfile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, outfile)
+
+    def print_profile(self, name, limit=20, sort="cumulative"):
+        """Print the cProfile of stage name (enable(profile=True))."""
+        self.profiles[name].sort_stats(sort).print_stats(limit)
+
+    def __str__(self):
+        summary = self.summary()
+        lines = ["%-24s %8d calls %10.3f s" % (name, s["calls"], s["seconds"])
+                 for name, s in summary["stages"].items()]
+        lines += ["%-24s %8d" % (name, n) for name, n in summary["counters"].items()]
+        return "\n".join(lines)
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# the recorder the PCR scripts report to; enable() it to start recording
+recorder = Recorder()
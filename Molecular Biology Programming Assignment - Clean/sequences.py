@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Sequence helpers shared by the PCR scripts: complements, templates
+with their derived strands computed once, a standalone 2-bit packed
+sequence type and FASTA reading.
+"""
+
+import gzip
+import mmap
+import os
+
+import numpy as np
+
+
+#=============================================================
+# Complements
+#=============================================================
+
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+def complement(seq):
+    """Base-by-base complement of seq (same direction)."""
+    return seq.translate(COMPLEMENT)
+
+
+def reverse_complement(seq):
+    """Reverse complement of seq, i.e. the other strand read 5' to 3'."""
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+#=============================================================
+# Templates
+#=============================================================
+
+class Template:
+    """A PCR template with its derived strands computed once.
+
+    sequence is the uppercased top strand, complement its base-by-base
+    complement (the bottom strand read 3' to 5', as PredictPCRProduct
+    aligns reversed primers against it) and reverse_complement the bottom
+    strand read 5' to 3'.  The strings are built once and then reused, so
+    alignment caches keyed on them hit by identity."""
+    def __init__(self, sequence, name=None):
+        self.name = name
+        self.sequence = sequence.upper()
+        self.complement = complement(self.sequence)
+        self.reverse_complement = self.complement[::-1]
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __str__(self):
+        return self.sequence
+
+    def __repr__(self):
+        return "Template(%s, %d bases)" % (self.name or "unnamed", len(self))
+
+
+def as_template(template):
+    """Return template unchanged if it is already a Template, otherwise
+    wrap the raw string in one."""
+    if isinstance(template, Template):
+        return template
+    return Template(template)
+
+
+#=============================================================
+# Packed sequences
+#=============================================================
+
+# 2-bit codes A, C, G, T = 0..3, so a base's complement is code ^ 3
+_BASE_CODE = np.zeros(256, dtype=np.uint8)
+_AMBIGUOUS = np.ones(256, dtype=bool)
+for _code, _base in enumerate("ACGT"):
+    _BASE_CODE[ord(_base)] = _BASE_CODE[ord(_base.lower())] = _code
+    _AMBIGUOUS[ord(_base)] = _AMBIGUOUS[ord(_base.lower())] = False
+# a packed byte holds four bases, the first in the high bits
+_UNPACK = np.array([[b"ACGT"[(byte >> shift) & 3] for shift in (6, 4, 2, 0)]
+                    for byte in range(256)], dtype=np.uint8)
+# the same byte with its four bases reversed and complemented
+_REVCOMP_BYTE = np.array([int("".join(format(3 - ((byte >> shift) & 3), "02b")
+                                      for shift in (0, 2, 4, 6)), 2)
+                          for byte in range(256)], dtype=np.uint8)
+
+
+class PackedSequence:
+    """A nucleotide sequence stored at 2 bits per base.
+
+    Anything other than A, C, G or T is ambiguous: it is packed as A and
+    flagged in a side bitmap (None when there are none) and reads back as
+    N.  Slicing with step 1 returns a view sharing the packed bytes, so
+    it costs O(1); reverse_complement() maps the packed bytes through a
+    256-entry table; to_array() gives the ASCII uint8 array the alignment
+    kernels take (alignment.encode accepts a PackedSequence directly).
+    Case is not kept.
+
+    This is a standalone type: nothing in the PCR scripts stores or
+    aligns PackedSequences.  Template and the search keep plain strings,
+    which the alignment and Tm code work on directly."""
+    def __init__(self, seq):
+        raw = np.frombuffer(seq.encode("ascii") if isinstance(seq, str) else bytes(seq),
+                            dtype=np.uint8)
+        self._length = len(raw)
+        self._start = 0
+        codes = np.zeros(-(-len(raw) // 4) * 4, dtype=np.uint8)
+        codes[:len(raw)] = _BASE_CODE[raw]
+        quads = codes.reshape(-1, 4)
+        self._packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+        ambiguous = _AMBIGUOUS[raw]
+        self._ambiguous = np.packbits(ambiguous) if ambiguous.any() else None
+
+    @classmethod
+    def _view(cls, packed, ambiguous, start, length):
+        view = cls.__new__(cls)
+        view._packed, view._ambiguous = packed, ambiguous
+        view._start, view._length = start, length
+        return view
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError("PackedSequence slices must have step 1")
+            return self._view(self._packed, self._ambiguous, self._start + start,
+                              max(stop - start, 0))
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("PackedSequence index out of range")
+        return chr(self[key:key + 1].to_array()[0])
+
+    def ambiguous(self):
+        """Boolean array marking the ambiguous positions."""
+        if self._ambiguous is None:
+            return np.zeros(self._length, dtype=bool)
+        bits = np.unpackbits(self._ambiguous, count=self._start + self._length)
+        return bits[self._start:].astype(bool)
+
+    def has_ambiguous(self):
+        """True if any base of this sequence (or view) is ambiguous."""
+        return self._ambiguous is not None and bool(self.ambiguous().any())
+
+    def codes(self):
+        """2-bit codes of the bases as a uint8 array (ambiguous bases 0)."""
+        first, last = self._start // 4, -(-(self._start + self._length) // 4)
+        shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+        codes = (self._packed[first:last, None] >> shifts) & 3
+        offset = self._start - 4 * first
+        codes = codes.ravel()[offset:offset + self._length]
+        if self.has_ambiguous():
+            # a reverse complement packs them as T
+            codes[self.ambiguous()] = 0
+        return codes
+
+    def to_array(self):
+        """The bases as an ASCII uint8 array, ambiguous bases as N."""
+        first, last = self._start // 4, -(-(self._start + self._length) // 4)
+        offset = self._start - 4 * first
+        array = _UNPACK[self._packed[first:last]].ravel()[offset:offset + self._length]
+        if self._ambiguous is not None:
+            array = array.copy()
+            array[self.ambiguous()] = ord("N")
+        return array
+
+    def reverse_complement(self):
+        """Reverse complement, built from the packed bytes by table lookup."""
+        first, last = self._start // 4, -(-(self._start + self._length) // 4)
+        packed = _REVCOMP_BYTE[self._packed[first:last]][::-1].copy()
+        # the reversed bytes end where the view started
+        start = 4 * (last - first) - (self._start - 4 * first) - self._length
+        ambiguous = None
+        if self.has_ambiguous():
+            flags = np.zeros(4 * len(packed), dtype=bool)
+            flags[start:start + self._length] = self.ambiguous()[::-1]
+            ambiguous = np.packbits(flags)
+        return self._view(packed, ambiguous, start, self._length)
+
+    def __str__(self):
+        return self.to_array().tobytes().decode("ascii")
+
+    def __repr__(self):
+        return "PackedSequence(%d bases)" % self._length
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedSequence):
+            return NotImplemented
+        return len(self) == len(other) and bool((self.to_array() == other.to_array()).all())
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+#=============================================================
+# FASTA
+#=============================================================
+
+# bytes dropped from sequence lines
+WHITESPACE = b" \t\r\n"
+
+
+def read_fasta(path):
+    """Yield (header, sequence) for every record of a FASTA file.
+
+    header is the text after '>' and sequence the record's bases as bytes,
+    with line breaks removed but case and ambiguity codes kept.
+    Uncompressed files are memory-mapped and each record is cut out with
+    one slice and one translate, so reading is linear and runs close to
+    disk speed; files ending in .gz are decompressed as a stream.  The
+    file stays open until the generator is exhausted or closed."""
+    if str(path).endswith(".gz"):
+        with gzip.open(path, "rb") as infile:
+            yield from _fasta_lines(infile)
+        return
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from _fasta_records(data)
+
+
+def _fasta_records(data):
+    """read_fasta over a buffer holding the whole file."""
+    pos = data.find(b">")
+    while pos != -1:
+        eol = data.find(b"\n", pos)
+        if eol == -1:
+            eol = len(data)
+        following = data.find(b"\n>", eol)
+        end = len(data) if following == -1 else following
+        header = data[pos + 1:eol].rstrip().decode()
+        yield header, data[eol:end].translate(None, WHITESPACE)
+        pos = -1 if following == -1 else following + 1
+
+
+def _fasta_lines(lines):
+    """read_fasta over an iterable of byte lines."""
+    header, parts = None, []
+    for line in lines:
+        if line.startswith(b">"):
+            if header is not None:
+                yield header, b"".join(parts).translate(None, WHITESPACE)
+            header, parts = line[1:].rstrip().decode(), []
+        elif header is not None:
+            parts.append(line)
+    if header is not None:
+        yield header, b"".join(parts).translate(None, WHITESPACE)
+
+
+def read_fasta_chunks(path, size=1 << 20, overlap=0):
+    """Yield (header, offset, chunk, last) windows over every record of a
+    FASTA file without holding a whole record in memory.
+
+    chunk is up to size bases (bytes) starting at base offset of the
+    record, consecutive chunks of a record share overlap bases, and last
+    marks the record's final chunk.  Every base is in at least one chunk;
+    a record shorter than size is one chunk."""
+    if overlap >= size:
+        raise ValueError("overlap must be smaller than the chunk size")
+    step = size - overlap
+    record = header = None
+    buf = bytearray()
+    offset = 0
+    for index, name, piece in _fasta_pieces(path):
+        if index != record:
+            if record is not None:
+                yield header, offset, bytes(buf), True
+            record, header = index, name
+            buf = bytearray()
+            offset = 0
+        buf += piece
+        # emit only while more bases follow, so the final chunk is known
+        while len(buf) > size:
+            yield header, offset, bytes(buf[:size]), False
+            del buf[:step]
+            offset += step
+    if record is not None:
+        yield header, offset, bytes(buf), True
+
+
+def _fasta_pieces(path, block=1 << 20):
+    """(record index, header, bases) pieces of a FASTA file in file order;
+    every record yields at least one (possibly empty) piece."""
+    if str(path).endswith(".gz"):
+        with gzip.open(path, "rb") as infile:
+            index = -1
+            for line in infile:
+                if line.startswith(b">"):
+                    index += 1
+                    header = line[1:].rstrip().decode()
+                    yield index, header, b""
+                elif index >= 0:
+                    yield index, header, line.translate(None, WHITESPACE)
+        return
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = 0
+            pos = data.find(b">")
+            while pos != -1:
+                eol = data.find(b"\n", pos)
+                if eol == -1:
+                    eol = len(data)
+                following = data.find(b"\n>", eol)
+                end = len(data) if following == -1 else following
+                header = data[pos + 1:eol].rstrip().decode()
+                yield index, header, b""
+                for lo in range(eol, end, block):
+                    yield index, header, data[lo:min(lo + block, end)].translate(None, WHITESPACE)
+                index += 1
+                pos = -1 if following == -1 else following + 1
+
+
+def read_templates(path):
+    """Every record of a FASTA file as a Template named after the first
+    word of its header."""
+    return [Template(seq.decode("ascii"), header.split()[0] if header else None)
+            for header, seq in read_fasta(path)]
+
+
+def check_fasta():
+    """Regression check: read_fasta gives every record of a file exactly,
+    whatever its line lengths and line endings, from plain and .gz files
+    alike, and read_fasta_chunks covers each record with chunks that
+    reassemble to it."""
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    records = [("seq%d description %d" % (i, i),
+                "".join(rng.choice("ACGTacgtN") for _ in range(rng.randrange(0, 5000))))
+               for i in range(6)]
+    text = []
+    for i, (header, seq) in enumerate(records):
+        width = rng.choice([60, 70, 80, 1000])
+        eol = "\r\n" if i % 2 else "\n"
+        text.append(">" + header + eol)
+        text += [seq[j:j + width] + eol for j in range(0, len(seq), width)]
+    # no newline after the last base
+    data = "".join(text).rstrip("\r\n").encode("ascii")
+    expected = [(header, seq.encode("ascii")) for header, seq in records]
+    with tempfile.TemporaryDirectory() as tmp:
+        plain = os.path.join(tmp, "records.fasta")
+        with open(plain, "wb") as outfile:
+            outfile.write(data)
+        with gzip.open(plain + ".gz", "wb") as outfile:
+            outfile.write(data)
+        for path in (plain, plain + ".gz"):
+            assert list(read_fasta(path)) == expected, path
+            for size, overlap in ((1, 0), (100, 0), (100, 99), (1000, 37), (1 << 20, 1000)):
+                chunks = list(read_fasta_chunks(path, size, overlap))
+                for header, seq in expected:
+                    mine = [c for c in chunks if c[0] == header]
+                    assert [c[3] for c in mine] == [False] * (len(mine) - 1) + [True]
+                    rebuilt = b""
+                    for _, offset, chunk, _ in mine:
+                        assert offset == len(rebuilt) - (overlap if offset else 0)
+                        assert 0 < len(chunk) <= size or not seq
+                        rebuilt = rebuilt[:offset] + chunk
+                    assert rebuilt == seq, (path, size, overlap, header)
+    print("check_fasta: %d records read and chunked from plain and .gz files" % len(records))
+
+
+def check_packed():
+    """Regression check: PackedSequence views, reverse complements and
+    ambiguity flags of random sequences, at every offset modulo 4, must
+    match the same operations on the plain string."""
+    import random
+
+    rng = random.Random(0)
+    for _ in range(300):
+        seq = "".join(rng.choice("ACGTACGTACGTNacgtRY") for _ in range(rng.randrange(0, 40)))
+        plain = "".join(b if b in "ACGT" else "N" for b in seq.upper())
+        packed = PackedSequence(seq)
+        assert str(packed) == plain and len(packed) == len(plain)
+        for _ in range(10):
+            start = rng.randrange(0, len(plain) + 1)
+            stop = rng.randrange(start, len(plain) + 1)
+            view = packed[start:stop]
+            part = plain[start:stop]
+            revcomp = reverse_complement(part)
+            for got, want in ((view, part), (view.reverse_complement(), revcomp),
+                              (view.reverse_complement().reverse_complement(), part),
+                              (view.reverse_complement()[1:-1], revcomp[1:-1])):
+                assert str(got) == want, (seq, start, stop, str(got), want)
+                assert got.has_ambiguous() == ("N" in want)
+                assert np.array_equal(got.ambiguous(), np.frombuffer(want.encode(), np.uint8) == ord("N"))
+                assert np.array_equal(got.codes(), [max("ACGT".find(b), 0) for b in want])
+            assert view == PackedSequence(part) and hash(view) == hash(PackedSequence(part))
+            if part:
+                assert packed[start] == plain[start] and view[-1] == part[-1]
+    print("check_packed: views, reverse complements and ambiguity flags match")
+
+
+if __name__ == "__main__":
+    check_fasta()
+    check_packed()
@@ -6,22 +6,329 @@ Created on Thu Oct  4 17:32:48 2018
 """
 import time
 import alignment
+import forest
+import instrument
+import sequences
+import tmstore
 import copy
 import functools
+import numpy as np
 # Your task is to *accurately* predict the primer melting points using machine 
 # learning based on the sequence of the primer.
 
 # Load the primers and their melting points.
 
 
-@functools.cache
+# alignments of the same primer against the same template are reused
+# across PredictPCRProduct calls; resize with alignment_cache.resize(n)
+alignment_cache = alignment.AlignmentCache(maxsize=4096)
+
+# predicted melting points by (model, primer): an LRU in front of a SQLite
+# file shared by pool workers and later runs; see tmstore.TmStore
+tm_store = tmstore.TmStore("tm_store.sqlite")
+
 def melting_point(primer, melting_point_rf):
-    return melting_point_rf.predict([CalculatePrimerFeatures(primer)])
+    return melting_points([primer], melting_point_rf)
+
+def melting_points(primers, melting_point_rf):
+    """Predicted melting points of many primers with a single predict call
+    on one 2-D feature array, instead of one call per primer.  Models that
+    work on sequences directly (NearestNeighborTm) get the primers.
+    Primers the model has already scored, in this run or an earlier one,
+    come from tm_store instead."""
+    return tm_store.lookup(_tm_model_key(melting_point_rf), primers,
+                           lambda missing: _predict_tm(missing, melting_point_rf))
+
+def _predict_tm(primers, melting_point_rf):
+    if hasattr(melting_point_rf, "predict_primers"):
+        return melting_point_rf.predict_primers(primers)
+    if not primers:
+        return np.zeros(0)
+    features = np.array([CalculatePrimerFeatures(p) for p in primers])
+    return melting_point_rf.predict(features)
+
+def _tm_model_key(melting_point_rf):
+    """tm_store key of a model: its fingerprint, plus that of
+    CalculatePrimerFeatures for models that predict from features."""
+    key = tmstore.fingerprint(melting_point_rf)
+    if not hasattr(melting_point_rf, "predict_primers"):
+        key += "-" + _code_digest(CalculatePrimerFeatures)
+    return key
 
 def CalculatePrimerFeatures(seq):
     # modify this function to return a python list of feature values for a given sequence for Task 1
     return [len(seq), seq.count("A"), seq.count("T"), seq.count("G"), seq.count("C")]
 
+def CalculateWindowFeatures(template, min_len=18, max_len=35, dinucleotides=False):
+    """
+    CalculatePrimerFeatures for every window template[s:s+L] with
+    min_len <= L <= max_len, in one NumPy pass over cumulative base counts.
+    Returns (features, starts, lengths, has_n): a (windows, 5) array whose
+    rows equal CalculatePrimerFeatures(template[s:s+L]), the window starts
+    and lengths, and a mask of windows containing an N.  With
+    dinucleotides the 16 overlapping dinucleotide counts (AA, AC, ..., TT)
+    are appended to each row.
+    """
+    seq = np.frombuffer(template.encode("ascii"), dtype=np.uint8)
+    n = len(seq)
+    lengths = np.arange(min_len, max_len + 1)
+    starts = np.arange(n)
+    # start-major order, dropping windows that run off the end
+    S, L = np.meshgrid(starts, lengths, indexing="ij")
+    keep = S + L <= n
+    S, L = S[keep], L[keep]
+
+    bases = [ord(b) for b in "ATGCN"]
+    prefix = np.zeros((n + 1, len(bases)), dtype=np.int64)
+    prefix[1:] = np.cumsum(seq[:, None] == np.array(bases, dtype=np.uint8), axis=0)
+    counts = prefix[S + L] - prefix[S]
+    columns = [L, counts[:, 0], counts[:, 1], counts[:, 2], counts[:, 3]]
+
+    if dinucleotides:
+        code = np.full(256, -1)
+        code[[ord(b) for b in "ACGT"]] = np.arange(4)
+        c = code[seq]
+        pair = np.where((c[:-1] >= 0) & (c[1:] >= 0), 4 * c[:-1] + c[1:], -1)
+        pairs = np.zeros((n, 16), dtype=np.int64)
+        pairs[1:] = np.cumsum(pair[:, None] == np.arange(16), axis=0)
+        # a window holds the dinucleotides starting at s .. s+L-2
+        columns += list((pairs[S + L - 1] - pairs[S]).T)
+
+    return np.column_stack(columns), S, L, counts[:, 4] > 0
+
+def check_window_features(trials=20, seed=0):
+    """
+    Regression check for CalculateWindowFeatures: on random templates with
+    N's, every window in start-major order, each row equal to
+    CalculatePrimerFeatures of the window followed by its overlapping
+    dinucleotide counts, and the N mask.
+    """
+    import itertools
+    import random
+
+    rng = random.Random(seed)
+    dinucleotides = ["".join(p) for p in itertools.product("ACGT", repeat=2)]
+    for _ in range(trials):
+        template = "".join(rng.choice("ACGTACGTN") for _ in range(rng.randint(0, 60)))
+        min_len = rng.randint(1, 20)
+        max_len = min_len + rng.randint(0, 15)
+        features, starts, lengths, has_n = CalculateWindowFeatures(
+            template, min_len, max_len, dinucleotides=True)
+        windows = [(s, L) for s in range(len(template))
+                   for L in range(min_len, max_len + 1) if s + L <= len(template)]
+        assert list(zip(starts.tolist(), lengths.tolist())) == windows, template
+        for row, n, (s, L) in zip(features.tolist(), has_n, windows):
+            window = template[s:s + L]
+            pairs = [sum(window[k:k + 2] == d for k in range(L - 1)) for d in dinucleotides]
+            assert row == CalculatePrimerFeatures(window) + pairs, (window, row)
+            assert n == ("N" in window), window
+        plain = CalculateWindowFeatures(template, min_len, max_len)[0]
+        assert np.array_equal(plain, features[:, :5]), template
+    print("check_window_features: %d random templates OK" % trials)
+
+#=============================================================
+# Nearest-neighbor melting point model
+#=============================================================
+
+# SantaLucia (1998) unified nearest-neighbor parameters: (dH kcal/mol,
+# dS cal/K/mol) for each 5'->3' dinucleotide of the top strand
+NN_PARAMS = {
+    "AA": (-7.9, -22.2), "TT": (-7.9, -22.2),
+    "AT": (-7.2, -20.4), "TA": (-7.2, -21.3),
+    "CA": (-8.5, -22.7), "TG": (-8.5, -22.7),
+    "GT": (-8.4, -22.4), "AC": (-8.4, -22.4),
+    "CT": (-7.8, -21.0), "AG": (-7.8, -21.0),
+    "GA": (-8.2, -22.2), "TC": (-8.2, -22.2),
+    "CG": (-10.6, -27.2), "GC": (-9.8, -24.4),
+    "GG": (-8.0, -19.9), "CC": (-8.0, -19.9),
+}
+# initiation with a terminal G.C or A.T pair, applied once per end
+NN_INIT = {"G": (0.1, -2.8), "C": (0.1, -2.8), "A": (2.3, 4.1), "T": (2.3, 4.1)}
+NN_SYMMETRY_DS = -1.4
+GAS_CONSTANT = 1.987
+
+def _nn_tables():
+    """Lookup tables indexed by base code (A, C, G, T = 0..3, anything
+    else 4); entries involving code 4 are NaN."""
+    pair_dh = np.full(25, np.nan)
+    pair_ds = np.full(25, np.nan)
+    for pair, (dh, ds) in NN_PARAMS.items():
+        idx = 5 * "ACGT".index(pair[0]) + "ACGT".index(pair[1])
+        pair_dh[idx], pair_ds[idx] = dh, ds
+    end_dh = np.full(5, np.nan)
+    end_ds = np.full(5, np.nan)
+    for base, (dh, ds) in NN_INIT.items():
+        end_dh["ACGT".index(base)], end_ds["ACGT".index(base)] = dh, ds
+    code = np.full(256, 4, dtype=np.int64)
+    for c, base in enumerate("ACGT"):
+        code[ord(base)] = code[ord(base.lower())] = c
+    return code, pair_dh, pair_ds, end_dh, end_ds
+
+class NearestNeighborTm:
+    """
+    Analytic melting point model: the SantaLucia (1998) nearest-neighbor
+    duplex thermodynamics with a monovalent salt correction, evaluated
+    with prefix sums over NumPy-encoded sequences so a whole template's
+    windows cost a handful of array operations.
+
+    Pass an instance anywhere a melting_point_rf is expected
+    (melting_point, melting_points, PredictPCRProduct, the primer search);
+    those call sites dispatch on predict_primers.  slope and intercept map
+    the thermodynamic Tm onto the lab's measurements; fit them with
+    calibrate().  Sequences containing anything but ACGT get NaN.
+    """
+    def __init__(self, na_conc=0.05, dna_conc=250e-9, slope=1.0, intercept=0.0):
+        self.na_conc = na_conc
+        self.dna_conc = dna_conc
+        self.slope = slope
+        self.intercept = intercept
+        self._code, self._pair_dh, self._pair_ds, self._end_dh, self._end_ds = _nn_tables()
+
+    def _encode(self, seq):
+        return self._code[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+
+    def _tm(self, c, S, L):
+        """Tm of the windows c[S:S+L] of the code array c."""
+        pair = 5 * c[:-1] + c[1:]
+        # exact prefix sums in tenths of a unit over the valid pairs, plus a
+        # count of invalid ones so a single N only poisons its own windows
+        bad = np.isnan(self._pair_dh[pair])
+        dh = np.zeros(len(c), dtype=np.int64)
+        ds = np.zeros(len(c), dtype=np.int64)
+        nbad = np.zeros(len(c), dtype=np.int64)
+        dh[1:] = np.cumsum(np.where(bad, 0, np.rint(10 * self._pair_dh[pair])).astype(np.int64))
+        ds[1:] = np.cumsum(np.where(bad, 0, np.rint(10 * self._pair_ds[pair])).astype(np.int64))
+        nbad[1:] = np.cumsum(bad)
+        first, last = c[S], c[S + L - 1]
+        # a window holds the dinucleotides starting at S .. S+L-2
+        dH = (dh[S + L - 1] - dh[S]) / 10 + self._end_dh[first] + self._end_dh[last]
+        dS = (ds[S + L - 1] - ds[S]) / 10 + self._end_ds[first] + self._end_ds[last]
+        dH[nbad[S + L - 1] > nbad[S]] = np.nan
+        dS = dS + 0.368 * (L - 1) * np.log(self.na_conc)
+
+        # self-complementary duplexes: symmetry penalty and full strand conc.
+        symmetric = np.zeros(len(S), dtype=bool)
+        for length in np.unique(L[L % 2 == 0]):
+            rows = np.flatnonzero(L == length)
+            ok = np.ones(len(rows), dtype=bool)
+            for t in range(length // 2):
+                ok &= c[S[rows] + t] + c[S[rows] + length - 1 - t] == 3
+            symmetric[rows] = ok
+        dS = dS + np.where(symmetric, NN_SYMMETRY_DS, 0.0)
+        conc = np.where(symmetric, self.dna_conc, self.dna_conc / 4)
+
+        tm = 1000 * dH / (dS + GAS_CONSTANT * np.log(conc)) - 273.15
+        return self.slope * tm + self.intercept
+
+    def predict_primers(self, primers):
+        """Tm of each primer, for all of them at once."""
+        primers = list(primers)
+        if not primers:
+            return np.zeros(0)
+        L = np.array([len(p) for p in primers])
+        S = np.concatenate([[0], np.cumsum(L)[:-1]])
+        return self._tm(self._encode("".join(primers)), S, L)
+
+    def predict_windows(self, template, min_len=18, max_len=35):
+        """Tm of every window template[s:s+L], min_len <= L <= max_len, in
+        the (start-major) order of CalculateWindowFeatures.  Returns
+        (tm, starts, lengths)."""
+        c = self._encode(template)
+        S, L = np.meshgrid(np.arange(len(c)), np.arange(min_len, max_len + 1), indexing="ij")
+        keep = S + L <= len(c)
+        S, L = S[keep], L[keep]
+        return self._tm(c, S, L), S, L
+
+    def calibrate(self, primers, melting_points):
+        """Least-squares fit of slope and intercept to measured Tm values."""
+        self.slope, self.intercept = 1.0, 0.0
+        raw = self.predict_primers(primers)
+        self.slope, self.intercept = np.polyfit(raw, melting_points, 1)
+        return self
+
+    def fingerprint(self):
+        """Short hash of the parameters, for tmstore."""
+        import hashlib
+        params = (self.na_conc, self.dna_conc, float(self.slope), float(self.intercept))
+        return hashlib.sha1(repr(("NearestNeighborTm",) + params).encode()).hexdigest()[:16]
+
+    def __repr__(self):
+        return "NearestNeighborTm(na_conc=%g, dna_conc=%g, slope=%.4f, intercept=%.4f)" % (
+            self.na_conc, self.dna_conc, self.slope, self.intercept)
+
+def compare_tm_models(path="training_primers.txt", template=None, folds=10):
+    """
+    Accuracy and speed of the nearest-neighbor model against the
+    RandomForest on the training primers, so we can tell when the fast
+    path is safe to use.  Prints cross-validated R2 and mean absolute
+    error for the forest, the raw thermodynamic Tm and the calibrated one,
+    and primers/windows per second for each model.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.metrics import mean_absolute_error, r2_score
+
+    primers, truth = [], []
+    with open(path) as infile:
+        infile.readline()
+        for line in infile:
+            Line = line.split()
+            primers.append(Line[0])
+            truth.append(float(Line[1]))
+    truth = np.array(truth)
+    features = np.array([CalculatePrimerFeatures(p) for p in primers])
+    fold = np.arange(len(primers)) % folds
+
+    rf_pred = np.zeros(len(primers))
+    nn_pred = np.zeros(len(primers))
+    for f in range(folds):
+        train, test = fold != f, fold == f
+        rf = RandomForestRegressor(n_estimators=200)
+        rf.fit(features[train], truth[train])
+        rf_pred[test] = rf.predict(features[test])
+        nn = NearestNeighborTm().calibrate([p for p, t in zip(primers, train) if t], truth[train])
+        nn_pred[test] = nn.predict_primers([p for p, t in zip(primers, test) if t])
+    raw_pred = NearestNeighborTm().predict_primers(primers)
+
+    print("%-22s %8s %8s" % ("model", "R2", "MAE"))
+    for name, pred in [("RandomForest", rf_pred), ("NN (raw)", raw_pred),
+                       ("NN (calibrated)", nn_pred)]:
+        print("%-22s %8.3f %8.2f" % (name, r2_score(truth, pred), mean_absolute_error(truth, pred)))
+
+    nn = NearestNeighborTm()
+    st = time.perf_counter()
+    rf.predict(features)
+    rf_rate = len(primers) / (time.perf_counter() - st)
+    st = time.perf_counter()
+    nn.predict_primers(primers)
+    nn_rate = len(primers) / (time.perf_counter() - st)
+    template = template or "".join(primers)
+    st = time.perf_counter()
+    windows = len(nn.predict_windows(template)[0])
+    window_rate = windows / (time.perf_counter() - st)
+    print("RandomForest: %.0f primers/s" % rf_rate)
+    print("NN: %.0f primers/s, %.0f windows/s" % (nn_rate, window_rate))
+
+def WindowMeltingPoints(template, melting_point_rf, min_len=18, max_len=35):
+    """
+    Melting points of every window template[s:s+L] and of its reverse
+    complement, as two arrays indexed [s, L] (NaN where there is no
+    window), predicted in bulk.
+    """
+    tm = np.full((len(template) + 1, max_len + 1), np.nan)
+    tm_rc = np.full((len(template) + 1, max_len + 1), np.nan)
+    if hasattr(melting_point_rf, "predict_windows"):
+        # a duplex and its reverse complement are the same molecule
+        predicted, starts, lengths = melting_point_rf.predict_windows(template, min_len, max_len)
+        tm[starts, lengths] = tm_rc[starts, lengths] = predicted
+        return tm, tm_rc
+    # the reverse complement of a window swaps its A/T and G/C counts
+    features, starts, lengths, has_n = CalculateWindowFeatures(template, min_len, max_len)
+    rc_features = features[:, [0, 2, 1, 4, 3]]
+    predicted = melting_point_rf.predict(np.vstack([features, rc_features]))
+    tm[starts, lengths] = predicted[:len(starts)]
+    tm_rc[starts, lengths] = predicted[len(starts):]
+    return tm, tm_rc
+
 def PredictPCRProduct(primer1, primer2, template_sequence, melting_point_rf):
     """
     Input:
@@ -29,7 +336,8 @@ def PredictPCRProduct(primer1, primer2, template_sequence, melting_point_rf):
         primer2 = a primer sequence in 5' to 3' order
         template_sequence = sequence from which we are trying to generate 
         copies using PCR in 5' to 3' order.  Assume this is double stranded, 
-        but we are only including the top strand in the argument.
+        but we are only including the top strand in the argument.  May be
+        a raw string or a sequences.Template (whose complement is reused).
         melting_point_rf = random forest learned from task1 to predict primer
         melting points.
     Output:
@@ -42,43 +350,40 @@ def PredictPCRProduct(primer1, primer2, template_sequence, melting_point_rf):
         return None
     if (len(primer2) < 18 or len(primer2) > 35):
         return None
-    melting_point1 = melting_point_rf.predict([CalculatePrimerFeatures(primer1)])
-    melting_point2 = melting_point_rf.predict([CalculatePrimerFeatures(primer2)])
+    melting_point1, melting_point2 = melting_points([primer1, primer2], melting_point_rf)
     
     if (abs(melting_point1 - 60) > 2 or abs(melting_point2 - 60) > 2):
         return None
     
-    pairs = {
-        "T": "A",
-        "A": "T",
-        "C": "G",
-        "G": "C",
-        "N": "N"
-    }
-    
-    compliment = "".join(list(map(lambda x : pairs[x], template_sequence)))
+    template = sequences.as_template(template_sequence)
+    template_sequence = template.sequence
+    compliment = template.complement
     
     #p2r == c && p1 == t
     #p1r == c && p2 == t
     
-    p1t_score = alignment.local_align(primer1, template_sequence)[0] / (10 * len(primer1))
-    p1rc_score = alignment.local_align(primer1[::-1], compliment)[0] / (10 * len(primer1))
-    p2t_score = alignment.local_align(primer2, template_sequence)[0] / (10 * len(primer2))
-    p2rc_score = alignment.local_align(primer2[::-1], compliment)[0] / (10 * len(primer2))
+    # the seed index gives local_align's score wherever it reaches .8,
+    # which is all the tests below look at
+    top = template_index(template_sequence)
+    bottom = template_index(compliment)
+    p1t_score = alignment_cache.local_align(primer1, template_sequence, index=top)[0] / (10 * len(primer1))
+    p1rc_score = alignment_cache.local_align(primer1[::-1], compliment, index=bottom)[0] / (10 * len(primer1))
+    p2t_score = alignment_cache.local_align(primer2, template_sequence, index=top)[0] / (10 * len(primer2))
+    p2rc_score = alignment_cache.local_align(primer2[::-1], compliment, index=bottom)[0] / (10 * len(primer2))
     
     if (p1t_score >= .8 and p2rc_score >= .8):
-        pos_left = alignment.local_align(primer1, template_sequence)[1][1]
-        pos_right = alignment.local_align(primer2[::-1], compliment)[1][1]
+        pos_left = product_start(primer1, template_sequence)
+        pos_right = product_end(primer2[::-1], compliment)
         print("pos_left: ", pos_left, " pos_right", pos_right)
         if (pos_left < pos_right):
-            return template_sequence[pos_left - len(primer1):pos_right]
+            return template_sequence[pos_left:pos_right]
         
     if (p2t_score >= .8 and p1rc_score >= .8):
-        pos_left = alignment.local_align(primer2, template_sequence)[1][1]
-        pos_right = alignment.local_align(primer1[::-1], compliment)[1][1]
+        pos_left = product_start(primer2, template_sequence)
+        pos_right = product_end(primer1[::-1], compliment)
         print("pos_left: ", pos_left, " pos_right", pos_right)
         if (pos_left < pos_right):
-            return template_sequence[pos_left - len(primer2):pos_right]
+            return template_sequence[pos_left:pos_right]
     
    
     return None
@@ -86,189 +391,824 @@ def PredictPCRProduct(primer1, primer2, template_sequence, melting_point_rf):
 
 
 
+def product_start(primer, strand):
+    """Template position of the primer's 5' end, from the traced binding
+    site so that gaps in the alignment are accounted for."""
+    aln = alignment_cache.traceback(primer, strand, index=template_index(strand))
+    return max(aln.y_start - aln.x_start, 0)
+
+def product_end(reversed_primer, strand):
+    """Template position just past the 5' end of a primer given reversed
+    (3' to 5') and aligned against the complement strand."""
+    aln = alignment_cache.traceback(reversed_primer, strand, index=template_index(strand))
+    return min(aln.y_end + len(reversed_primer) - aln.x_end, len(strand))
+
+def binding_sites(primers, templates):
+    """
+    Where each primer binds each template, as two (primers, templates)
+    arrays: start[p, t] is where a product primed by primers[p] on the top
+    strand begins (product_start) and end[p, t] is just past the end of a
+    product primed on the bottom strand (product_end); -1 where the best
+    alignment on that strand scores below 80% of a perfect match.  These
+    are the sites PredictPCRProduct uses, found with a bit-parallel screen
+    and one batched seed-and-extend pass per template and strand.
+    """
+    templates = [sequences.as_template(t) for t in templates]
+    primers = list(primers)
+    full = 10 * np.array([len(p) for p in primers])
+    start = np.full((len(primers), len(templates)), -1)
+    end = np.full((len(primers), len(templates)), -1)
+    reversed_primers = [q[::-1] for q in primers]
+    with instrument.recorder.stage("alignment"):
+        for t, template in enumerate(templates):
+            for p, aln in _strand_sites(primers, template.sequence, full):
+                start[p, t] = max(aln.y_start - aln.x_start, 0)
+            for p, aln in _strand_sites(reversed_primers, template.complement, full):
+                end[p, t] = min(aln.y_end + len(primers[p]) - aln.x_end, len(template))
+    return start, end
+
+def _strand_sites(queries, strand, full):
+    """(query index, traced Alignment) for every query whose best alignment
+    on strand reaches 80% of full; the bit-parallel screen drops most
+    non-binders before any DP runs.  Throughput samples of the screened
+    queries and the sites found are taken once the strand is done."""
+    recorder = instrument.recorder
+    candidates = np.flatnonzero(alignment.may_bind_many(queries, strand))
+    recorder.count("screen.queries", len(queries))
+    recorder.count("screen.passed", len(candidates))
+    best, optloc = template_index(strand).align_many([queries[p] for p in candidates])
+    for p, b, loc in zip(candidates, best, optloc):
+        if b / full[p] >= .8:
+            recorder.count("alignment.sites")
+            yield p, alignment.traceback(queries[p], strand, b, tuple(loc))
+    for name in ("screen.queries", "alignment.sites"):
+        recorder.sample(name, recorder.counters.get(name, 0))
+
+@functools.lru_cache(maxsize=64)
+def template_index(strand):
+    """Seed index of a template strand, built once and shared by every
+    PredictPCRProduct, binding_sites and PredictPCRPanel call on it."""
+    return alignment.TemplateIndex(strand)
+
+def product_bounds(start1, end1, start2, end2):
+    """
+    Template slice [left, right) of the products of primer pairs, from
+    their binding_sites rows (any broadcastable shapes), with left = right
+    = 0 where PredictPCRProduct finds no product: the first primer forward
+    and the second reverse, else the other way round.
+    """
+    forward = (start1 >= 0) & (end2 > start1)
+    backward = (start2 >= 0) & (end1 > start2)
+    left = np.where(forward, start1, np.where(backward, start2, 0))
+    right = np.where(forward, end2, np.where(backward, end1, 0))
+    return left, right
+
+def join_products(start1, end1, start2, end2):
+    """Product lengths for primer pairs from their binding_sites rows, 0
+    where there is no product (see product_bounds)."""
+    left, right = product_bounds(start1, end1, start2, end2)
+    return right - left
+
+def PredictPCRPanel(primer1, primer2, templates, melting_point_rf):
+    """
+    PredictPCRProduct for one primer pair against a whole panel of
+    templates: a list of sequences or Templates, or a directory or glob
+    pattern of FASTA files (see load_templates).  Each primer is aligned
+    once per template strand, against indexes shared across calls.
+
+    Returns one (name, product, length) row per template, in order, with
+    product None and length 0 where there is no product.  Templates
+    without a name are numbered from 1.
+    """
+    templates = load_templates(templates)
+    names = [t.name or str(n + 1) for n, t in enumerate(templates)]
+    if (not 18 <= len(primer1) <= 35 or not 18 <= len(primer2) <= 35
+            or any(abs(tm - 60) > 2 for tm in melting_points([primer1, primer2], melting_point_rf))):
+        return [(name, None, 0) for name in names]
+    start, end = binding_sites([primer1, primer2], templates)
+    left, right = product_bounds(start[0], end[0], start[1], end[1])
+    return [(name, t.sequence[a:b] if b > a else None, int(b - a))
+            for name, t, a, b in zip(names, templates, left, right)]
+
+def _chunk_sites(primers, chunk):
+    """
+    Every binding site of each primer on one chunk of template, as
+    (primer index, strand, position, score) in chunk coordinates.  A site
+    is the best alignment inside one seed window of TemplateIndex scoring
+    at least 80% of a perfect match; position is product_start of it on
+    the top strand ("+") and product_end on the bottom strand ("-").
+    Primers too short for the seed filter get one site per chunk, the
+    best one.
+    """
+    comp = sequences.complement(chunk)
+    sites = []
+    for strand, strand_seq in (("+", chunk), ("-", comp)):
+        index = alignment.TemplateIndex(strand_seq)
+        for p, primer in enumerate(primers):
+            query = primer if strand == "+" else primer[::-1]
+            windows = index.windows(query)
+            if windows is None:
+                windows = [(0, len(chunk))]
+            scores, ends = alignment.local_align_windows(query, strand_seq, windows)
+            for (w0, w1), best, (i, j) in zip(windows, scores, ends):
+                if best / (10 * len(primer)) < .8:
+                    continue
+                aln = alignment.traceback(query, strand_seq[w0:w1], best, (i, j - w0))
+                if strand == "+":
+                    position = w0 + aln.y_start - aln.x_start
+                else:
+                    position = w0 + aln.y_end + len(query) - aln.x_end
+                sites.append((p, strand, int(position), best.item()))
+    return sites
+
+def stream_binding_sites(primers, path, overlap, chunk_size=1 << 20):
+    """
+    Yield (record, primer index, strand, position, score) for every
+    binding site of the primers on every record of a FASTA file (see
+    _chunk_sites), with position in record coordinates.  The records are
+    scanned in chunk_size chunks overlapping by overlap bases, so memory
+    stays bounded by the chunk size whatever the genome size.  A site is
+    reported by the chunk its primer footprint starts in, once.
+    """
+    step = chunk_size - overlap
+    for header, offset, chunk, last in sequences.read_fasta_chunks(path, chunk_size, overlap):
+        chunk = chunk.decode("ascii").upper()
+        for p, strand, position, score in _chunk_sites(primers, chunk):
+            footprint = position if strand == "+" else position - len(primers[p])
+            if not last and footprint >= step:
+                continue
+            if footprint < 0 and offset > 0:
+                continue
+            position = min(max(position, 0), len(chunk))
+            yield header, p, strand, offset + position, score
+
+def PredictPCRStream(primer1, primer2, path, melting_point_rf, max_product=1000,
+                     chunk_size=1 << 20):
+    """
+    In-silico PCR against FASTA files too large to hold in memory, such as
+    whole bacterial genomes.  Yields (record, start, end, product) for
+    every product of at most max_product bases, in record coordinates:
+    primer1 priming the top strand and primer2 the bottom one, or the
+    other way round, as in PredictPCRProduct, but at every binding site
+    rather than only the best one.
+
+    Chunks overlap by max_product plus the primer length, so each product
+    lies wholly inside the chunk its start falls in.
+    """
+    if (not 18 <= len(primer1) <= 35 or not 18 <= len(primer2) <= 35
+            or any(abs(tm - 60) > 2 for tm in melting_points([primer1, primer2], melting_point_rf))):
+        return
+    overlap = max_product + max(len(primer1), len(primer2))
+    step = chunk_size - overlap
+    for header, offset, chunk, last in sequences.read_fasta_chunks(path, chunk_size, overlap):
+        chunk = chunk.decode("ascii").upper()
+        sites = _chunk_sites([primer1, primer2], chunk)
+        ends = [(p, min(pos, len(chunk))) for p, strand, pos, _ in sites if strand == "-"]
+        products = set()
+        for p, strand, pos, _ in sites:
+            if strand != "+" or (not last and pos >= step) or (pos < 0 and offset > 0):
+                continue
+            left = max(pos, 0)
+            for q, right in ends:
+                if q != p and 0 < right - left <= max_product:
+                    products.add((left, right))
+        for left, right in sorted(products):
+            yield header, offset + left, offset + right, chunk[left:right]
+
+def check_stream(melting_point_rf=None, seed=0):
+    """
+    Regression check for PredictPCRStream: on a random two-record genome
+    with products planted in both orientations, some straddling chunk
+    boundaries, every chunk size must find the same products as one
+    whole-record chunk, from plain and .gz files, and the planted
+    products must be among them.
+    """
+    import gzip
+    import os
+    import random
+    import tempfile
+
+    rng = random.Random(seed)
+    melting_point_rf = melting_point_rf or tm_model()
+    # two random primers the model puts at 58-62 C
+    candidates = ["".join(rng.choice("ACGT") for _ in range(rng.randrange(18, 26)))
+                  for _ in range(2000)]
+    tm = _predict_tm(candidates, melting_point_rf)
+    primer1, primer2 = [p for p, t in zip(candidates, tm) if abs(t - 60) <= 1.5][:2]
+
+    records, planted = [], set()
+    for r in range(2):
+        genome = [rng.choice("ACGT") for _ in range(60000)]
+        # spaced so products straddle the 2.5 kb and 5 kb chunk boundaries
+        for start in range(2400 + 700 * r, len(genome) - 1000, 4900):
+            inner = "".join(rng.choice("ACGT") for _ in range(rng.randrange(60, 900)))
+            product = primer1 + inner + sequences.reverse_complement(primer2)
+            if rng.random() < .5:
+                product = sequences.reverse_complement(product)
+            genome[start:start + len(product)] = product
+            planted.add(("record%d" % r, start, start + len(product)))
+        records.append("".join(genome))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "genome.fasta")
+        text = "".join(">record%d\n%s\n" % (r, "\n".join(g[i:i + 70] for i in range(0, len(g), 70)))
+                       for r, g in enumerate(records))
+        with open(path, "w") as outfile:
+            outfile.write(text)
+        with gzip.open(path + ".gz", "wt") as outfile:
+            outfile.write(text)
+        def products(path, chunk_size):
+            return sorted(r[:3] for r in PredictPCRStream(primer1, primer2, path, melting_point_rf,
+                                                        chunk_size=chunk_size))
+        expected = products(path, 1 << 20)
+        assert planted <= set(expected), sorted(planted - set(expected))
+        for chunk_size in (2500, 5000, 20000):
+            assert products(path, chunk_size) == expected, chunk_size
+        assert products(path + ".gz", 5000) == expected
+    print("check_stream: %d products (%d planted) at every chunk size" % (
+        len(expected), len(planted)))
+
+def load_templates(templates):
+    """
+    Templates from a list of sequences or Templates, or from a directory
+    (every *.fasta and *.fasta.gz in it) or glob pattern of FASTA files,
+    one per record, named after the record headers.
+    """
+    import glob
+    import os
+    if isinstance(templates, str):
+        if os.path.isdir(templates):
+            paths = (glob.glob(os.path.join(templates, "*.fasta"))
+                     + glob.glob(os.path.join(templates, "*.fasta.gz")))
+        else:
+            paths = glob.glob(templates)
+        return [t for path in sorted(paths) for t in sequences.read_templates(path)]
+    return [sequences.as_template(t) for t in templates]
+
+
+
+
 def LoadFastA(path):
-    infile = open(path, 'r')
-    seq = ""
-    infile.readline()
-    for line in infile:
-        seq += line[:-1]
-    return seq
-
-task2_randomforest = None
-    
-if __name__ == "__main__":
-   # stuff only to run when not called via 'import' here
-   from sklearn.metrics import r2_score
-   from sklearn.ensemble import RandomForestRegressor
-   import importlib
-   import os
-   import sys
-
-   print("Running Task 1:")
-   
-   infile = open("training_primers.txt", 'r')
-   infile.readline() # don't load headers
-   primers = []
-   melting_points = []
-   features = []
-   st = time.time()
-   for line in infile:
-       Line = line.split()
-       primers.append(Line[0])
-       melting_points.append(float(Line[1]))
-       # calculate features
-       features.append(CalculatePrimerFeatures(Line[0]))
-   feat_time = (time.time()-st)/(len(features)/1000)
-   # cross validation
-   how_many_folds = 10 
-   predictions = []
-   truth = []
-   my_len = len(features[-1])
-    
-   for fold in range(how_many_folds):
-        #print ("Calculating Fold",fold)
-        training_features = []
-        training_outcomes = []
-        testing_features = []
-        testing_outcomes = []
-        for c in range(len(melting_points)):
-            if c % how_many_folds == fold:
-                # put this one in testing data
-                testing_features.append(features[c])
-                testing_outcomes.append(melting_points[c])
-            else:
-                # put this one in training data
-                training_features.append(features[c])
-                training_outcomes.append(melting_points[c])
-        # train the model
-        
-        rf = RandomForestRegressor(n_estimators = 200)
-        rf.fit(training_features, training_outcomes)
-        fold_predictions = rf.predict(testing_features)
-        truth += testing_outcomes
-        predictions += list(fold_predictions)
-      
-           
-   #truth = np.array(truth)
-   #predictions = np.array(predictions)        
-   print("Task 1 Results:\n")
-   print("R2 Score:", r2_score(truth, predictions))
-   
-   """
-   Task 2:
-   Design a function to predict whether a product will be made in a PCR reaction.
-   Your function should take as input the template DNA and the two primers and 
-   return the product or 'None'.
-
-   This requires a local alignment function which is provided for you or you 
-   can use another implementation.
+    """Sequence of the first record of a FASTA file (.gz allowed); see
+    sequences.read_fasta for all records."""
+    for header, seq in sequences.read_fasta(path):
+        return seq.decode("ascii")
+    return ""
+
+#=============================================================
+# Melting point model
+#=============================================================
+
+# trained models by training-file hash, filled on first use by tm_model()
+_tm_models = {}
+
+def load_training_primers(path="training_primers.txt"):
+    """(primers, melting points) from a training file with a header line."""
+    primers = []
+    melting_points = []
+    with open(path) as infile:
+        infile.readline() # don't load headers
+        for line in infile:
+            Line = line.split()
+            primers.append(Line[0])
+            melting_points.append(float(Line[1]))
+    return primers, melting_points
+
+def _file_digest(path):
+    """Short SHA-1 of a file's contents."""
+    import hashlib
+    with open(path, "rb") as infile:
+        return hashlib.sha1(infile.read()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=None)
+def _code_digest(fn):
+    """Short SHA-1 of a function's source (its bytecode and constants when
+    there is no source), so editing the function changes the digest."""
+    import hashlib
+    import inspect
+    try:
+        code = inspect.getsource(fn).encode()
+    except (OSError, TypeError):
+        code = fn.__code__.co_code + repr(fn.__code__.co_consts).encode()
+    return hashlib.sha1(code).hexdigest()[:16]
+
+def training_features(feature_fn=CalculatePrimerFeatures, path="training_primers.txt",
+                      cache_dir="feature_cache", timed=False):
+    """
+    (features, melting points) arrays for a training file, where row i of
+    features is feature_fn of primer i.
+
+    Both arrays are cached as .npy files in cache_dir, named after the
+    hashes of the training file and of feature_fn's code, so editing
+    either one invalidates the cache.  Features are stored column-major
+    (each feature contiguous) and a hit is a zero-copy memory-mapped
+    load.  Edits to helpers that feature_fn calls are not detected;
+    delete the cache files after changing one.  cache_dir=None always
+    recomputes.  With timed, a third value is the seconds feature_fn
+    took over all primers, or None when the features came from the cache.
+    """
+    import os
+    if cache_dir is None:
+        primers, melting_points = load_training_primers(path)
+        st = time.perf_counter()
+        features = np.array([feature_fn(p) for p in primers], dtype=float)
+        result = (features, np.array(melting_points))
+        return result + (time.perf_counter() - st,) if timed else result
+    data = _file_digest(path)
+    feature_file = os.path.join(cache_dir, "%s_%s_%s.npy" % (
+        feature_fn.__name__, data, _code_digest(feature_fn)))
+    target_file = os.path.join(cache_dir, "melting_points_%s.npy" % data)
+    seconds = None
+    if not (os.path.exists(feature_file) and os.path.exists(target_file)):
+        features, melting_points, seconds = training_features(feature_fn, path, None, True)
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, array in ((feature_file, np.asfortranarray(features)),
+                            (target_file, melting_points)):
+            with open(name + ".tmp", "wb") as outfile:
+                np.save(outfile, array)
+            os.replace(name + ".tmp", name)
+    result = (np.load(feature_file, mmap_mode="r"), np.load(target_file, mmap_mode="r"))
+    return result + (seconds,) if timed else result
+
+def check_training_features():
+    """
+    Regression check for the training_features cache: a fresh file or
+    feature_fn recomputes (timed), a repeat is a memory-mapped hit, and
+    editing the training file or swapping feature_fn recomputes again.
+    """
+    import os
+    import tempfile
+
+    def gc_features(seq):
+        return [len(seq), seq.count("G") + seq.count("C")]
+
+    def at_features(seq):
+        return [len(seq), seq.count("A") + seq.count("T")]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "primers.txt")
+        cache_dir = os.path.join(tmp, "cache")
+
+        def load(feature_fn, recomputed, primers):
+            features, truth, seconds = training_features(feature_fn, path, cache_dir, timed=True)
+            assert (seconds is not None) == recomputed, (feature_fn.__name__, seconds)
+            assert isinstance(features, np.memmap) and isinstance(truth, np.memmap)
+            assert np.array_equal(features, [feature_fn(p) for p in primers])
+            assert np.array_equal(truth, np.arange(len(primers)))
+
+        for primers in (["ACGT", "GGCCA"], ["ACGT", "GGCCA", "TTTA"]):
+            with open(path, "w") as outfile:
+                outfile.write("Primer Tm\n")
+                outfile.writelines("%s %d\n" % (p, i) for i, p in enumerate(primers))
+            load(gc_features, True, primers)
+            load(gc_features, False, primers)
+            load(at_features, True, primers)
+            load(at_features, False, primers)
+            load(gc_features, False, primers)
+    print("check_training_features: cache hits and recomputes as expected")
+
+def random_forest_model():
+    """The Task 1 model: a 200-tree RandomForestRegressor."""
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor(n_estimators = 200)
+
+def train_tm_model(path="training_primers.txt", model_factory=random_forest_model):
+    """Fit the task 2 RandomForest (or model_factory()) on every primer of
+    the training file."""
+    features, melting_points = training_features(CalculatePrimerFeatures, path)
+    rf = model_factory()
+    rf.fit(features, melting_points)
+    return rf
+
+def tm_model(path="training_primers.txt", cache_dir=".", model_factory=random_forest_model):
+    """
+    The task 2 melting point model, trained or loaded on first use.
+
+    The trained forest is saved flattened (forest.FlatForest, identical
+    predictions) as task2_forest_<hash>.npz in cache_dir, keyed by the
+    SHA-1 of the training file and of the code of CalculatePrimerFeatures
+    and model_factory, so it is retrained when the data, the features or
+    the model change, and loading it needs neither training nor sklearn.
+    """
+    import hashlib
+    import os
+    digest = hashlib.sha1(" ".join([
+        _file_digest(path), _code_digest(CalculatePrimerFeatures),
+        model_factory.__qualname__, _code_digest(model_factory)]).encode()).hexdigest()[:16]
+    if digest not in _tm_models:
+        artifact = os.path.join(cache_dir, "task2_forest_%s.npz" % digest)
+        if os.path.exists(artifact):
+            model = forest.FlatForest.load(artifact)
+        else:
+            model = forest.FlatForest.from_sklearn(train_tm_model(path, model_factory))
+            os.makedirs(cache_dir, exist_ok=True)
+            model.save(artifact)
+        _tm_models[digest] = model
+    return _tm_models[digest]
+
+def _fit_fold(model_factory, threads, X_train, y_train, X_test):
+    """Train one cross-validation fold; returns (predictions, seconds)."""
+    # a forked worker inherits native thread pools (BLAS, OpenMP) already
+    # started by the parent, so they are limited here rather than via
+    # environment variables
+    from threadpoolctl import threadpool_limits
+    st = time.perf_counter()
+    with threadpool_limits(threads):
+        model = model_factory()
+        if hasattr(model, "get_params") and "n_jobs" in model.get_params():
+            model.set_params(n_jobs=threads)
+        model.fit(X_train, y_train)
+        predictions = model.predict(X_test)
+    return predictions, time.perf_counter() - st
+
+def evaluate_tm_model(feature_fn=CalculatePrimerFeatures, model_factory=random_forest_model,
+                      path="training_primers.txt", how_many_folds=10, workers=None,
+                      threads_per_fold=1, cache_dir="feature_cache"):
+    """
+    Cross-validated accuracy of a melting point model built from
+    model_factory() (a picklable callable) on the features feature_fn
+    computes for each primer.
+
+    The features come from training_features (cached in cache_dir);
+    primer c is tested in fold c % how_many_folds, as before.  Folds are
+    fit concurrently on a ProcessPoolExecutor with `workers` processes
+    (1 fits them here, one after another), each limited to
+    threads_per_fold threads (n_jobs for sklearn models and the native
+    thread pools).  Prints and returns a dict with the R2 score, the
+    mean absolute error, per-fold fit seconds, features/sec (feature_fn
+    itself, timed when training_features computes the features; None
+    when they come from the cache) and the out-of-fold predictions.
+    """
+    import concurrent.futures
+    from sklearn.metrics import mean_absolute_error, r2_score
+
+    features, truth, feature_seconds = training_features(feature_fn, path, cache_dir, timed=True)
+    fold_of = np.arange(len(truth)) % how_many_folds
+
+    predictions = np.zeros(len(truth))
+    fold_seconds = [0.0] * how_many_folds
+    jobs = [(model_factory, threads_per_fold, features[fold_of != fold],
+             truth[fold_of != fold], features[fold_of == fold])
+            for fold in range(how_many_folds)]
+    st = time.perf_counter()
+    if workers == 1:
+        results = [_fit_fold(*job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fit_fold, *zip(*jobs)))
+    wall_seconds = time.perf_counter() - st
+    for fold, (fold_predictions, seconds) in enumerate(results):
+        predictions[fold_of == fold] = fold_predictions
+        fold_seconds[fold] = seconds
+
+    report = {
+        "r2": r2_score(truth, predictions),
+        "mae": mean_absolute_error(truth, predictions),
+        "fold_seconds": fold_seconds,
+        "wall_seconds": wall_seconds,
+        "features_per_second": None if feature_seconds is None else len(truth) / feature_seconds,
+        "predictions": predictions,
+    }
+    print("R2 Score:", report["r2"], " MAE:", report["mae"])
+    rate = report["features_per_second"]
+    print("Features: %s  Folds: %s s (%.2f s wall)" % (
+        "cached" if rate is None else "%.0f primers/s" % rate,
+        ", ".join("%.2f" % t for t in fold_seconds), wall_seconds))
+    return report
+
+def task1(path="training_primers.txt", how_many_folds=10):
+    """Task 1: cross-validated R2 of the melting point RandomForest."""
+    print("Running Task 1:")
+    evaluate_tm_model(CalculatePrimerFeatures, random_forest_model, path, how_many_folds)
+
+def task2():
+    """
+    Task 2:
+    Design a function to predict whether a product will be made in a PCR reaction.
+    Your function should take as input the template DNA and the two primers and 
+    return the product or 'None'.
+
+    This requires a local alignment function which is provided for you or you 
+    can use another implementation.
     
-   There are test cases in PCR_product_test_cases.txt.
-   
-   correct temperature
-   >80% alignment
-   primer reverse matches with original DNA
-   
-   """
-   task2_randomforest = RandomForestRegressor(n_estimators = 200)
-   task2_randomforest.fit(features, melting_points)
-   
-   PredictPCRProduct("AACTACGGAGAACTACAGCAACCT", "TGGTGGGATGTCTTTCAACAGG",  "ACGTCAGCGAGCGCTACGACGTGGTGGGATGTCTTTCAACAGGACGGACTGACGCGACGACTGACTGTAGGCTAGGTTGCTGTAGTTCTCCGTAGTTAGCTACGACGCATGCAGCTGCA", task2_randomforest)
-   
-   
-   """
-   Task 3:
-   Design primers for a PCR reaction to distinguish between the three types 
-   of DNA.  
-   
-   -Your primers should be between 18 and 35 bases long.  
-   -They should have at least 80% match to the DNA strand.
-   -Predicted melting points of any primers to be run in the same reaction
-   should be between 58.0 and 62.0 C.
-   -Products are distinguishable in length if their difference in length is >40
-   bases
-   -Your products should not be longer than 1000 bases.
-   
-   We are making predictions about the functionality of sets of primers.  We 
-   will synthesize your group's primers and test them in the lab later.
-     
-   
-   """
+    There are test cases in PCR_product_test_cases.txt.
    
+    correct temperature
+    >80% alignment
+    primer reverse matches with original DNA
+    """
+    return PredictPCRProduct("AACTACGGAGAACTACAGCAACCT", "TGGTGGGATGTCTTTCAACAGG",  "ACGTCAGCGAGCGCTACGACGTGGTGGGATGTCTTTCAACAGGACGGACTGACGCGACGACTGACTGTAGGCTAGGTTGCTGTAGTTCTCCGTAGTTAGCTACGACGCATGCAGCTGCA", tm_model())
 
-def get_primers_to_diff(DNA : list):
-    short = min(DNA)
-    pairs = {
-        "T": "A",
-        "A": "T",
-        "C": "G",
-        "G": "C"
-    }
-    c = 0
-    c1 = 0
-    c2 = 0
-    c3 = 0
-    c4 = 0
-    c5 = 0 
-    c6 = 0
-    n2 = 0
-    # i = [0,17], [285,386]
-    for i in range(283, len(short) - 80):
-        print("I : ", i)
-        for j in range(i + 19,i + 37):
-            p1 = short[i:j]
-            if ("N" in p1):
-                continue
-            if (abs(melting_point(p1, task2_randomforest)-60) > 2):
+
+#=============================================================
+# Primer pair search
+#=============================================================
+
+class PrimerPair:
+    """A candidate primer pair found by get_primers_to_diff.
+
+    p1 = short[i:j] is the forward primer and p2rc the reverse complement
+    of short[k:l], where short is the template the candidates are cut
+    from.  lengths holds the product length on each template of the
+    panel, 0 where there is no product."""
+    def __init__(self, i, j, k, l, p1, p2rc, lengths):
+        self.i = i
+        self.j = j
+        self.k = k
+        self.l = l
+        self.p1 = p1
+        self.p2rc = p2rc
+        self.lengths = list(lengths)
+
+    @property
+    def amplified(self):
+        """Number of templates with a product."""
+        return sum(1 for n in self.lengths if n)
+
+    @property
+    def spread(self):
+        """Longest minus shortest product."""
+        lens = [n for n in self.lengths if n]
+        return max(lens) - min(lens) if lens else 0
+
+    def to_dict(self):
+        return {"i": self.i, "j": self.j, "k": self.k, "l": self.l,
+                "p1": self.p1, "p2rc": self.p2rc, "lengths": self.lengths}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["i"], d["j"], d["k"], d["l"], d["p1"], d["p2rc"], d["lengths"])
+
+    def __repr__(self):
+        return "PrimerPair(%s, %s, lengths=%s)" % (self.p1, self.p2rc, self.lengths)
+
+
+def pair_score(pair):
+    """Default ranking for get_primers_to_diff: more templates amplified
+    first, then a wider spread of product lengths."""
+    return (pair.amplified, pair.spread)
+
+
+# per-process search state, filled once per worker by _search_init
+_search_state = {}
+
+def _search_init(forward, reverse):
+    _search_state.update(forward=forward, reverse=reverse)
+
+def _search_worker_init(forward, reverse, options):
+    _search_init(forward, reverse)
+    instrument.recorder.reset()
+    if options:
+        instrument.recorder.enable(**options)
+
+def _search_task(lo, hi):
+    """_search_partition in a pool worker, with what it recorded."""
+    hits = _search_partition(lo, hi)
+    return hits, instrument.recorder.drain() if instrument.recorder.enabled else None
+
+
+def _search_partition(lo, hi):
+    """All qualifying pairs whose forward primer starts in [lo, hi)."""
+    import bisect
+    f_pos, f_primers, f_start, f_end = _search_state["forward"]
+    r_pos, r_primers, r_start, r_end = _search_state["reverse"]
+    r_k = r_pos[:, 0]
+    hits = []
+    checked = 0
+    with instrument.recorder.stage("product_checks"):
+        for f in range(bisect.bisect_left(f_pos[:, 0], lo), bisect.bisect_left(f_pos[:, 0], hi)):
+            i, j = f_pos[f]
+            first_k = bisect.bisect_left(r_k, j + 20)
+            lengths = join_products(f_start[f], f_end[f], r_start[first_k:], r_end[first_k:])
+            checked += len(lengths)
+            made = lengths > 0
+            longest = np.where(made, lengths, 0).max(axis=1)
+            shortest = np.where(made, lengths, 1 << 30).min(axis=1)
+            ok = (made[:, 0] & (made.sum(axis=1) >= 3) & (longest - shortest >= 40)
+                  & (shortest > 40) & (longest < 1000))
+            for r in np.flatnonzero(ok) + first_k:
+                k, l = r_pos[r]
+                hits.append(PrimerPair(int(i), int(j), int(k), int(l), f_primers[f],
+                                       r_primers[r], lengths[r - first_k].tolist()))
+    instrument.recorder.count("pairs.checked", checked)
+    instrument.recorder.count("pairs.kept", len(hits))
+    return hits
+
+
+def _cache_counts():
+    """Lookup counters of the template index cache, the one cache the
+    search goes through, for it to report how often it hits."""
+    info = template_index.cache_info()
+    return {"template_index.hits": info.hits, "template_index.misses": info.misses}
+
+
+def _search_tables(short, DNA, melting_point_rf, checkpoint_dir, key):
+    """
+    The forward and reverse candidate tables of get_primers_to_diff, each
+    (positions, primers, start, end) with the binding_sites of every
+    candidate.  Building them is most of a search, so with checkpoint_dir
+    they are saved there under key and a resumed search loads them.
+    """
+    import os
+    path = checkpoint_dir and os.path.join(checkpoint_dir, "sites.npz")
+    if path and os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved["key"]) == key:
+                instrument.recorder.count("checkpoint.sites_loaded")
+                return tuple((saved[side + "_pos"], saved[side + "_primers"].tolist(),
+                              saved[side + "_start"], saved[side + "_end"])
+                             for side in ("forward", "reverse"))
+
+    recorder = instrument.recorder
+    # predict every candidate's melting point in bulk before any alignment
+    with recorder.stage("tm_filter"):
+        tm_p1, tm_p2rc = WindowMeltingPoints(short, melting_point_rf, 19, 36)
+        f_pos, f_primers = _candidate_primers(short, tm_p1, False)
+        r_pos, r_primers = _candidate_primers(short, tm_p2rc, True)
+    recorder.count("candidates.forward", len(f_primers))
+    recorder.count("candidates.reverse", len(r_primers))
+    tables = ((f_pos, f_primers) + binding_sites(f_primers, DNA),
+              (r_pos, r_primers) + binding_sites(r_primers, DNA))
+    if path:
+        arrays = {"key": key}
+        for side, (pos, primers, start, end) in zip(("forward", "reverse"), tables):
+            arrays.update({side + "_pos": pos, side + "_primers": np.array(primers, dtype=str),
+                           side + "_start": start, side + "_end": end})
+        with open(path + ".tmp", "wb") as outfile:
+            np.savez(outfile, **arrays)
+        os.replace(path + ".tmp", path)
+    return tables
+
+
+def _candidate_primers(short, tm, reverse):
+    """Windows short[s:e] (reverse-complemented if reverse) that PredictPCRProduct
+    would accept on length and melting point, as ((n, 2) positions, primers)."""
+    # N's before each position, so no window is sliced to look for one
+    ambiguous = np.concatenate([[0], np.cumsum(np.frombuffer(short.encode(), np.uint8) == ord("N"))])
+    positions, primers = [], []
+    for s in range(len(short) - (40 if reverse else 80)):
+        for e in range(s + 19, s + 37):
+            if e - s > 35 or ambiguous[e] > ambiguous[s] or abs(tm[s, e - s] - 60) > 2:
                 continue
-            print("J : ", j)
-            for k in range(j + 20, len(short) - 40):
-                for l in range(k + 19, k + 37):
-                    c += 1
-                    if(c % 1000 == 0):
-                        print("Count: ", c, " Progress: ", (i * 18 + (j - i - 18)) * 100 /(len(short) - 80), "%", "c1: ", c1, "c2: ", c2, "c3: ", c3, "c4: ", c4, "c5: ", c5, "c6: ", c6, "n2: ", n2)
-                    p2 = short[k:l]
-                    if ("N" in p2):
-                        continue
-                   
-                    p2r = p2[::-1]
-                    p2rc = "".join(list(map(lambda x : pairs[x], p2r)))
-                    if (abs(melting_point(p2rc, task2_randomforest)-60) > 2):
-                        continue
-                    prod1 = PredictPCRProduct(p1, p2rc, DNA[0], task2_randomforest)
-                    
-                    if (prod1):
-                        c1 += 1
-                        prods = [prod1] + list(map(lambda x : PredictPCRProduct(p1, p2rc, x, task2_randomforest), DNA[1:]))
-                        count = sum(list(map(lambda x : 1 if x else 0, prods)))
-                        if (prods[1]):
-                            c2 += 1
-                        if (prods[2]):
-                            c3 += 1
-                        if (prods[3]):
-                            c4 += 1
-                        if (prods[4]):
-                            c5 += 1
-                        if (prods[5]):
-                            c6 += 1
-                            
-                        if (count == 2):
-                            n2 += 1
-                        if (count >= 3):
-                            filtered = filter(None,prods)
-                            lens = list(map(len, filtered))
-                            
-                            if(max(lens) - min(lens) >= 40 and min(lens) > 40 and max(lens) < 1000): 
-                                print(lens)
-                                # for le in lens:
-                                #     if (abs(le - max(lens)) >= 40 and abs(le - min(lens) >= 40)):
-                                print("p1: ", p1)
-                                print(melting_point(p1, task2_randomforest))
-                                print("p2rc: ", p2rc)
-                                print(melting_point(p2rc, task2_randomforest))
-                                print(list(map(lambda x : 1 if x else 0, prods)))
-                                return (p1, p2rc)
-                    
+            positions.append((s, e))
+            primers.append(sequences.reverse_complement(short[s:e]) if reverse else short[s:e])
+    return np.array(positions, dtype=np.int64).reshape(-1, 2), primers
+
+
+def get_primers_to_diff(DNA : list, melting_point_rf=None, first=0, last=None,
+                        partition=4, workers=None, checkpoint_dir=None,
+                        top_k=None, score=pair_score, progress=10.0):
+    """
+    Search min(DNA), the first template in sort order, for primer pairs
+    that amplify at least 3 templates (the first among them) with products
+    between 40 and 1000 bases whose lengths differ by at least 40, both
+    primers predicted at 58-62 C.
+
+    Every candidate primer is aligned once per template and strand
+    (binding_sites); a pair's products then come from joining the two
+    primers' sites (join_products) instead of running PredictPCRProduct
+    per pair and template, with the same result.
+
+    Forward primer starts first..last are cut into partitions of
+    `partition` starts and joined on a ProcessPoolExecutor with `workers`
+    processes (1 searches in this process); the site tables are sent to
+    each worker once.  With checkpoint_dir every finished partition is
+    written there, and a rerun with the same templates and model skips the
+    partitions already on disk, so a killed run picks up where it stopped;
+    the candidates' binding sites are saved there too, so a resumed run
+    does not align them again.
+
+    Returns every qualifying PrimerPair, best first by score (a key
+    function, pair_score by default), or only the top_k of them.
+    melting_point_rf defaults to tm_model().
+
+    Progress is printed at most every `progress` seconds (None for
+    silence).  With instrument.recorder enabled, the search reports its
+    stages (tm_filter, alignment, product_checks, including time in the
+    workers), pair counts, throughput, template index cache hits and
+    checkpoint reuse there.
+    """
+    import concurrent.futures
+    import hashlib
+    import json
+    import os
+
+    short = str(min(DNA, key=str))
+    DNA = [sequences.as_template(x) for x in DNA]
+    melting_point_rf = melting_point_rf or tm_model()
+    if last is None:
+        last = len(short) - 80
+    recorder = instrument.recorder
+    caches = _cache_counts()
+
+    # partitions depend on the templates and on the Tm filter's model
+    key = hashlib.sha1("\n".join([_tm_model_key(melting_point_rf)]
+                                 + [t.sequence for t in DNA]).encode()).hexdigest()
+    partitions = [(lo, min(lo + partition, last)) for lo in range(first, last, partition)]
+    hits = []
+    done = 0
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        todo = []
+        for lo, hi in partitions:
+            path = os.path.join(checkpoint_dir, "partition_%06d_%06d.json" % (lo, hi))
+            if os.path.exists(path):
+                with open(path) as infile:
+                    saved = json.load(infile)
+                if saved["key"] == key:
+                    hits += [PrimerPair.from_dict(d) for d in saved["hits"]]
+                    done += 1
+                    continue
+            todo.append((lo, hi))
+        partitions = todo
+        if done:
+            recorder.count("partitions.resumed", done)
+            if progress is not None:
+                print("Resuming: %d partitions loaded from %s" % (done, checkpoint_dir))
+
+    total = len(partitions)
+    left = total
+    last_print = time.perf_counter()
+
+    def finished(lo, hi, found, drained=None):
+        nonlocal left, last_print
+        if drained is not None:
+            recorder.merge(drained)
+        if checkpoint_dir:
+            path = os.path.join(checkpoint_dir, "partition_%06d_%06d.json" % (lo, hi))
+            with open(path + ".tmp", "w") as outfile:
+                json.dump({"key": key, "hits": [p.to_dict() for p in found]}, outfile)
+            os.replace(path + ".tmp", path)
+        hits.extend(found)
+        left -= 1
+        recorder.count("partitions.done")
+        recorder.sample("pairs.checked", recorder.counters.get("pairs.checked", 0))
+        now = time.perf_counter()
+        if progress is not None and (now - last_print >= progress or not left):
+            last_print = now
+            print("Searched %d/%d partitions (%.0f%%), %d hits" % (
+                total - left, total, 100 * (total - left) / total, len(hits)))
+
+    if not partitions:
+        pass
+    elif workers == 1:
+        _search_init(*_search_tables(short, DNA, melting_point_rf, checkpoint_dir, key))
+        for lo, hi in partitions:
+            finished(lo, hi, _search_partition(lo, hi))
+    else:
+        init_args = _search_tables(short, DNA, melting_point_rf, checkpoint_dir, key)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_search_worker_init,
+                initargs=init_args + (recorder.options(),)) as pool:
+            futures = {pool.submit(_search_task, lo, hi): (lo, hi)
+                       for lo, hi in partitions}
+            for future in concurrent.futures.as_completed(futures):
+                finished(*futures[future], *future.result())
+
+    for name, n in _cache_counts().items():
+        recorder.count(name, n - caches[name])
+    hits.sort(key=score, reverse=True)
+    return hits[:top_k] if top_k else hits
+
+
+def check_search(DNA, melting_point_rf=None, pairs=300, seed=0):
+    """
+    Regression check for the primer search: for random pairs of its
+    forward and reverse candidates, the product lengths join_products
+    gives from binding_sites must equal len(PredictPCRProduct(...)) on
+    every template.  Candidates are sampled first, so only those are
+    aligned.
+    """
+    import contextlib
+    import io
+    import random
+
+    rng = random.Random(seed)
+    DNA = [sequences.as_template(x) for x in DNA]
+    melting_point_rf = melting_point_rf or tm_model()
+    short = str(min(DNA, key=str))
+    tm_p1, tm_p2rc = WindowMeltingPoints(short, melting_point_rf, 19, 36)
+    f_primers = _candidate_primers(short, tm_p1, False)[1]
+    r_primers = _candidate_primers(short, tm_p2rc, True)[1]
+    f_primers = rng.sample(f_primers, min(len(f_primers), 60))
+    r_primers = rng.sample(r_primers, min(len(r_primers), 60))
+    f_start, f_end = binding_sites(f_primers, DNA)
+    r_start, r_end = binding_sites(r_primers, DNA)
+
+    products = 0
+    for _ in range(pairs):
+        f, r = rng.randrange(len(f_primers)), rng.randrange(len(r_primers))
+        lengths = join_products(f_start[f], f_end[f], r_start[r], r_end[r])
+        # PredictPCRProduct prints the positions it finds
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [PredictPCRProduct(f_primers[f], r_primers[r], t, melting_point_rf)
+                        for t in DNA]
+        expected = [len(p) if p else 0 for p in expected]
+        assert lengths.tolist() == expected, (f_primers[f], r_primers[r], lengths, expected)
+        products += sum(1 for n in expected if n)
+    print("check_search: %d pairs x %d templates (%d products) match PredictPCRProduct"
+          % (pairs, len(DNA), products))
+
 DNA = [
     "catgctcagattgacgctgcggcaggcttaacacatgcaagtcgagcggggatagggtgcttgcnnngattcctagcggcggacgggtgagtaatgcttaggaatctgcctattagtgggggacaacgttccgaaagggacgctaataccgcatacgtcctacgggagaaagcaggggatcttcggaccttgcgctaatagatgagcctaagtcggattagctagttggtggggtaaaggcctaccaaggcgacgatctgtagcgggtctgagaggatgatccgccacactgggactgagacacggcccagactcctacgggaggcagcagtggggaatattggacaatggggggaaccctgatccagccatgccgcgtgtgtgaagaaggccttttggttgtaaagcactttaagcgaggaggaggcttacctggttaatacctgggataagtggacgttactcgcagaataagcaccggctaactctgtgccagcagccgcggtaatacagagggtgcaagcgttaatcggatttactgggcgtAaagcgcgcgtaggtggctaattaagtcaaatgtgaaatccccgagcttaacttgggaattgcattcgatactggttagctagagtatgggagaggatggtagaattccaggtgtagcggtgaaatgcgtagagatctggaggaataccgatggcgaaggcagccatctggcctaatactgacactgaggtgcgaaagcatggggagcaaacaggattagataccctggtagtccatgccgtaaacgatgtctactagccgttggggcccttgaggctttagtggcgcagctaacgcgataagtagaccgcctggggagtacggtcgcaagactaaaactcaaatgaattgacgggggcccgcacaagcggtggagcatgtggtttaattcgatgcaacgcgaagaaccttacctggccttgacatacagagaactttccagagatggattggtgccttcgggaactctgatacaggtgctgcatggctgtcgtcagctcgtgtcgtgagatgttgggttaagtcccgcaacgagcgcaacccttttccttatttgccagcacttcgggtgggaactttaaggatactgccagtgacaaactggaggaaggcggggacgacgtcaagtcatcatggcccttacggccagggctacacacgtgctacaatggtcggtacaaagggttgctactgcgcgagcagatgctaatctcaaaaagccgatcgtagtccggatcgcagtctgcaactcgactgcgtgaagtcggaatcgctagtaatcgcggatcagaatgccgcggtgaatacgttcccgggccttgtacacaccgcccgtcacaccatgggagtttgttgcaccagaagtaggtagtctaacctt",
     "tacatgcaagtcgagcgaactgacgaggagcttgctcctttgacgttagcggcggacgggtgagtaacacgtgggtaacctacctataagactggaataactccgggaaaccggggctaatgccggataacatgttgaaccgcatggttcaacattgaaaggcggttttgctgtcacttatagatggacctgcgccgtattagctagttggtnaggtaatggcttaccaaggcgacgatacgtagccgacctgagagggtgatcggccacactggaactgagacacggtccagactcctacgggaggcagcagtagggaatcttccgcaatggacgaaagtctgacggagcaacgccgcgtgagtgatgaaggttttcggatcgtaaagctctgttattagggaagaacaagtgcgtaggtaactatgcgcaccttgacggtacctaatcagaaagccacggctaactacgtgccagcagccgcggtaatacgtaggtggcaagcgttatccggaattattgggcgtaaagcgcgcgtaggcggtttcttaagtctgatgtgaaagcccacggctcaaccgtggatggtcattggaaactggggaacttgagtgcagaagaggaaagtggaattccatgtgtagcggtgaaatgcgcagagatatggaggaacaccagtggcgaaggcgactttctggtctgtaactgacgctgatgtgcgaaagcgtggggatcaaacaggattagataccctggtagtccacgccgtaaacgatgagtgctaagtgttagggggtttccgccccttagtgctgcagctaacgcattaagcactccgcctggggagtacgatcgcaagattgaaactcaaaggaattgacggggacccgcacaagcggtggagcatgtggtttaattcgaagcaacgcgaagaaccttaccaaatcttgacatcctttgatcgctctagagatagagttttccccttcgggggacaaagtgacaggtggtgcatggttgtcgtcagctcgtgtcgtgagatgttgggttaagtcccgcaacgagcgcaacccttaagcttagttgccatcattaagttgggcactctaagttgactgccggtgacaaaccggaggaaggtggggatgacgtcaaatcatcatgccccttatgatttgggctacacacgtgctacaatggacggtacaaagggtcgctaaaccgcgaggtcaagcaaatcccataaagccgttctcagttcggattgtagtctgcaactcgactacatgaagctggaatcgctagtaatcgtagatcagcatgctacggtgaatacnttcccgggtcttgtacacaccgcccgtcacaccacgagagtttgtaacacccgaagccggtggagtaacctttggagctagccgtcga",
@@ -278,41 +1218,61 @@ DNA = [
     "catgctcagaacgacgctgcggcatgcctaatacatgcaagtcgaacgatcctttcggggatagtggcgcacgggtgcgtaacgcgtgggaatctgcccntngggttcggaataacttcgggaaactgaagctaataccggatgatgacgaaagtccaaagatttatcgcccagggatgagcccgcgtaggattagctagttggtggggtaaaggcctaccaaggcgacgatccttagctggtctgagaggatgatcagccacactgggactgagacacggcccagactcctacgggaggcagcagtagggaatattggacaatgggcgaaagcctgatccagcaatgccgcgtgagtgatgaaggccttagggttgtaaagctcttttacccgagatgataatgacagtatcgggagaataagctccggctaactccgtgccagcagccgcggtaatacggagggagctagcgttgttCGgAattactgggcgtAaagcgcacgtaggcggcgatttaagtcagaggtgaaagcccggggctcaaccccggaactgcctttgagactggattgctagaatcttggagaggcgagtggaattccgagtgtagaggtgaaattcgtagatattcggaagaacaccagtggcgaaggcggctcgctggacaagtattgacgctgaggtgcgaaagcgtggggagcaaacaggattagataccctggtagtccacgccgtaaacgatgataactagctgctggggcacatggtgtttcggtggcgcagctaacgcattaagttatccgcctggggagtacggtcgcaagattaaaactcaaaggaattgacgggggcctgcacaagcggtggagcatgtggtttaattcgaagcaacgcgcagaaccttaccagcgtttgacatcctcatcgcggatttcagagatgatttccttcagttcggctggatgagtgacaggtgctgcatggctgtcgtcagctcgtgtcgtgagatgttgggttaagtcccgcaacgagcgcaaccctcgcctttagttgccagcattcagttgggtactctaaaggaaccgccggtgataagccggaggaaggtggggatgacgtcaagtcctcatggcccttacgcgctgggctacacacgtgctacaatggcgactacagtgggctgcaaccgtgcgagcggtagctaatctccaaaagtcgtctcagttcggattgttctctgcaactcgagagcatgaaggcggaatcgctagtaatcgcggatcagcatgccgcggtgaatacgttcccnngccttgtacacaccgcccgtcacaccatgggatttggattcacccganncactgc"
     ]
 
-get_primers_to_diff(list(map(lambda x : x.upper(), DNA)))
-
 def reverse_comp(x):
-    pairs = {
-        "T": "A",
-        "A": "T",
-        "C": "G",
-        "G": "C"
-    }
-    r = x[::-1]
-    rc = "".join(list(map(lambda x : pairs[x], r)))
-    return rc
+    return sequences.reverse_complement(x)
 
+def task3(checkpoint_dir="primer_search", top_k=10):
+    """
+    Task 3:
+    Design primers for a PCR reaction to distinguish between the three types 
+    of DNA.  
+    
+    -Your primers should be between 18 and 35 bases long.  
+    -They should have at least 80% match to the DNA strand.
+    -Predicted melting points of any primers to be run in the same reaction
+    should be between 58.0 and 62.0 C.
+    -Products are distinguishable in length if their difference in length is >40
+    bases
+    -Your products should not be longer than 1000 bases.
+    
+    We are making predictions about the functionality of sets of primers.  We 
+    will synthesize your group's primers and test them in the lab later.
+    """
+    for pair in get_primers_to_diff(list(map(lambda x : x.upper(), DNA)),
+                                    checkpoint_dir=checkpoint_dir, top_k=top_k):
+        print(pair)
 
-# [0,49,0,736,736,49]
-p1 = "CCACACTGGGACTGAGACA".upper()
-p1_norm = p1.lower()
-p2 = "TACTCTGCTCCCGAAGGAG"
-p2_norm = reverse_comp(p2).lower()
+def product_table():
+    """Melting points and product lengths of our chosen pair on each template."""
+    # [0,49,0,736,736,49]
+    p1 = "CCACACTGGGACTGAGACA".upper()
+    p1_norm = p1.lower()
+    p2 = "TACTCTGCTCCCGAAGGAG"
+    p2_norm = reverse_comp(p2).lower()
 
-# [979, 136, 136, 979, 979, 955]
-# p1 = "GCCGCGTGTGTGTTGAAG".upper()
-# p1_norm = p1.lower()
-# p2 = "ATTGACCGCGGCATGCTG"
-# p2_norm = reverse_comp(p2).lower()
+    # [979, 136, 136, 979, 979, 955]
+    # p1 = "GCCGCGTGTGTGTTGAAG".upper()
+    # p1_norm = p1.lower()
+    # p2 = "ATTGACCGCGGCATGCTG"
+    # p2_norm = reverse_comp(p2).lower()
 
+    print(melting_point(p1, tm_model()))
+    print(melting_point(p2, tm_model()))
 
+    panel = [sequences.Template(x, name) for x, name in zip(DNA, ["1", "2", "3", "5", "6", "7"])]
+    for name, product, length in PredictPCRPanel(p1, p2, panel, tm_model()):
+        print(name, length)
 
-print(melting_point(p1, task2_randomforest))
-print(melting_point(p2, task2_randomforest))
 
-print("1", len(PredictPCRProduct(p1,p2,DNA[0].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[0].upper(), task2_randomforest) else 0)
-print("2", len(PredictPCRProduct(p1,p2,DNA[1].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[1].upper(), task2_randomforest) else 0)
-print("3", len(PredictPCRProduct(p1,p2,DNA[2].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[2].upper(), task2_randomforest) else 0)
-print("5", len(PredictPCRProduct(p1,p2,DNA[3].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[3].upper(), task2_randomforest) else 0)
-print("6", len(PredictPCRProduct(p1,p2,DNA[4].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[4].upper(), task2_randomforest) else 0)
-print("7", len(PredictPCRProduct(p1,p2,DNA[5].upper(), task2_randomforest)) if PredictPCRProduct(p1,p2,DNA[5].upper(), task2_randomforest) else 0)
+if __name__ == "__main__":
+    # stuff only to run when not called via 'import' here
+    import sys
+
+    if "--compare-tm" in sys.argv:
+        compare_tm_models()
+        sys.exit()
 
+    task1()
+    task2()
+    task3()
+    product_table()
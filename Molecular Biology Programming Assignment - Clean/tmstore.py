@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent melting point store: predicted primer melting points kept in
+a SQLite file keyed by (model fingerprint, primer), behind a bounded
+in-process LRU, so repeated runs and pool workers skip primers that a
+model has already scored.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import weakref
+
+import numpy as np
+
+
+# fingerprints of models without a fingerprint() method, by object:
+# (the model's attributes when it was hashed, digest)
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _attributes(model):
+    """The model's attributes, with list lengths, as held when hashed.
+    Fitting assigns new fitted attributes (a warm start extends a list),
+    so a refit changes this; holding the values keeps their ids unique."""
+    return [(name, value, len(value) if isinstance(value, list) else None)
+            for name, value in sorted(vars(model).items())]
+
+
+def _unchanged(old, new):
+    return len(old) == len(new) and all(
+        a[0] == b[0] and a[1] is b[1] and a[2] == b[2] for a, b in zip(old, new))
+
+
+def fingerprint(model):
+    """Short hash identifying a model's predictions.
+
+    Models with a fingerprint() method (FlatForest, NearestNeighborTm)
+    provide their own.  Anything else is hashed through pickle, and the
+    hash is reused while the model's attributes are the same objects, so
+    refitting or set_params rehashes it; changing an array of a fitted
+    model in place does not."""
+    if hasattr(model, "fingerprint"):
+        return model.fingerprint()
+    attributes = _attributes(model) if hasattr(model, "__dict__") else None
+    try:
+        seen, digest = _fingerprints[model]
+        if attributes is not None and _unchanged(seen, attributes):
+            return digest
+    except (KeyError, TypeError):
+        pass
+    digest = hashlib.sha1(pickle.dumps(model, protocol=4)).hexdigest()[:16]
+    if attributes is not None:
+        try:
+            _fingerprints[model] = (attributes, digest)
+        except TypeError:
+            pass
+    return digest
+
+
+class TmStore:
+    """Melting points by (model key, primer), in memory and on disk.
+
+    The most recent maxsize entries are held in an LRU; misses go to the
+    SQLite file at path (None keeps everything in memory), which runs in
+    WAL mode so any number of processes can read it while one writes.
+    The connection is opened on first use and reopened in a forked
+    child, so a store inherited by pool workers works in each of them.
+    hits, disk_hits and misses count primers looked up since the last
+    clear()."""
+    def __init__(self, path="tm_store.sqlite", maxsize=65536):
+        self.path = path
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode this only syncs at checkpoints, which is safe
+            # against process crashes and costs no fsync per commit
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS tm (model TEXT, primer TEXT, tm REAL, "
+                    "PRIMARY KEY (model, primer)) WITHOUT ROWID")
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def lookup(self, model, primers, compute):
+        """Melting points of primers under the model keyed model, as an
+        array.  compute(missing) predicts the primers found in neither
+        layer, all at once; its results are stored in both."""
+        primers = list(primers)
+        with self._lock:
+            found = {}
+            missing = []
+            for primer in dict.fromkeys(primers):
+                key = (model, primer)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[primer] = self._entries[key]
+                else:
+                    missing.append(primer)
+            self.hits += len(found)
+            if missing and self.path is not None:
+                on_disk = self._read(model, missing)
+                self.disk_hits += len(on_disk)
+                for primer, tm in on_disk.items():
+                    self._remember((model, primer), tm)
+                found.update(on_disk)
+                missing = [p for p in missing if p not in on_disk]
+            if missing:
+                self.misses += len(missing)
+                computed = dict(zip(missing, (float(tm) for tm in compute(missing))))
+                for primer, tm in computed.items():
+                    self._remember((model, primer), tm)
+                found.update(computed)
+                if self.path is not None:
+                    self._write(model, computed)
+        return np.array([found[p] for p in primers], dtype=float)
+
+    def _read(self, model, primers, batch=500):
+        connection = self._connect()
+        found = {}
+        for first in range(0, len(primers), batch):
+            chunk = primers[first:first + batch]
+            rows = connection.execute(
+                "SELECT primer, tm FROM tm WHERE model = ? AND primer IN (%s)"
+                % ",".join("?" * len(chunk)), [model] + chunk)
+            # SQLite stores NaN as NULL
+            found.update((p, np.nan if tm is None else tm) for p, tm in rows)
+        return found
+
+    def _write(self, model, values):
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO tm VALUES (?, ?, ?)",
+                [(model, p, None if np.isnan(tm) else tm) for p, tm in values.items()])
+
+    def resize(self, maxsize):
+        """Change the in-memory bound, evicting the least recently used."""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Empty the in-memory layer; the file is left alone."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = self._pid = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "%d/%d entries in memory (%s); hits = %d; disk hits = %d; misses = %d" % (
+            len(self._entries), self.maxsize, self.path or "no file", self.hits,
+            self.disk_hits, self.misses)
+
+
+def check_store():
+    """Regression check: values survive the LRU, a reopen and a forked
+    reader, NaN round-trips, and compute only sees unseen primers."""
+    import multiprocessing
+    import tempfile
+
+    computed = []
+    def compute(primers):
+        computed.extend(primers)
+        return [np.nan if "N" in p else len(p) for p in primers]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tm.sqlite")
+        store = TmStore(path, maxsize=2)
+        primers = ["ACGT", "ACGTN", "AC", "ACGT"]
+        first = store.lookup("m", primers, compute)
+        assert computed == ["ACGT", "ACGTN", "AC"]
+        assert np.array_equal(first, [4, np.nan, 2, 4], equal_nan=True)
+        assert np.array_equal(store.lookup("m", primers, compute), first, equal_nan=True)
+        assert len(computed) == 3 and len(store) == 2 and store.disk_hits == 1
+        store.close()
+
+        reopened = TmStore(path)
+        assert np.array_equal(reopened.lookup("m", primers, compute), first, equal_nan=True)
+        assert len(computed) == 3 and reopened.disk_hits == 3
+        reopened.lookup("other", ["AC"], compute)
+        assert computed[-1] == "AC"
+        with multiprocessing.get_context("fork").Pool(2) as pool:
+            assert pool.map(_check_worker, [path] * 2) == [[4.0, 2.0]] * 2
+        reopened.close()
+    check_fingerprint()
+    print("check_store: %s" % reopened)
+
+
+def check_fingerprint():
+    """A refitted sklearn model must get a new fingerprint, an unchanged
+    one keep its own."""
+    from sklearn.ensemble import RandomForestRegressor
+    X = np.arange(40.0).reshape(20, 2)
+    rf = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, X[:, 0])
+    first = fingerprint(rf)
+    assert fingerprint(rf) == first
+    rf.fit(X, X[:, 1])
+    refitted = fingerprint(rf)
+    assert refitted != first
+    rf.set_params(warm_start=True, n_estimators=8).fit(X, X[:, 1])
+    assert fingerprint(rf) not in (first, refitted)
+
+
+def _check_worker(path):
+    store = TmStore(path)
+    def compute(primers):
+        raise AssertionError("worker recomputed %s" % primers)
+    return list(store.lookup("m", ["ACGT", "AC"], compute))
+
+
+if __name__ == "__main__":
+    check_store()